@@ -0,0 +1,544 @@
+'''
+Micro benchmarks and parity checks for the inference optimisations of TransNuSeg.
+
+    python benchmark.py edge_trunk --batch_size=1 --repeat=5
+'''
+import argparse
+import io
+import itertools
+import math
+import os
+import tempfile
+import time
+
+import torch
+import torch.nn.functional as F
+
+from model_io import COMPACT_SUFFIX, load_checkpoint, save_compact
+from models.transnuseg import (HEADS, Shared_SwinTransformerBlock, TransNuSeg, drop_path_residual, get_shift_index,
+                               get_window_index, shiftmlp, window_partition, window_reverse)
+from utils import DiceLoss, MultiHeadDiceCELoss, edge_detection, edge_detection_torch
+
+
+
+def time_forward(model, x, repeat=5, warmup=1):
+    '''
+    returns the outputs of the last run and the mean latency in seconds
+    '''
+    with torch.no_grad():
+        for _ in range(warmup):
+            outputs = model(x)
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        s = time.perf_counter()
+        for _ in range(repeat):
+            outputs = model(x)
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        e = time.perf_counter()
+    return outputs, (e - s) / repeat
+
+
+def time_train_step(model, x, repeat=5, warmup=1):
+    '''
+    mean latency in seconds of a forward and backward pass in training mode
+    '''
+    model.train()
+    for i in range(warmup + repeat):
+        if i == warmup:
+            if x.is_cuda:
+                torch.cuda.synchronize()
+            s = time.perf_counter()
+        sum(output.float().mean() for output in model(x)).backward()
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    e = time.perf_counter()
+    model.zero_grad(set_to_none=True)
+    return (e - s) / repeat
+
+
+def build_model(args):
+    model = TransNuSeg(img_size=args.img_size, in_chans=args.in_chans)
+    model.to(args.device)
+    model.eval()
+    return model
+
+
+def random_input(args):
+    return torch.rand(args.batch_size, args.in_chans, args.img_size, args.img_size, device=args.device)
+
+
+def bench_edge_trunk(args):
+    '''
+    normal/cluster edge decoders computed separately vs. the shared edge trunk computed once
+    '''
+    model = build_model(args)
+    x = random_input(args)
+
+    model.share_edge_trunk = False
+    ref, t_ref = time_forward(model, x, args.repeat)
+    model.share_edge_trunk = True
+    out, t_out = time_forward(model, x, args.repeat)
+
+    for name, a, b in zip(["nuclei", "normal edge", "cluster edge"], ref, out):
+        assert torch.equal(a, b), "{} output differs with the shared edge trunk".format(name)
+    print("edge trunk: separate {:.4f}s, shared {:.4f}s, saving {:.1f}%, outputs bit-identical".format(
+        t_ref, t_out, 100 * (1 - t_out / t_ref)))
+
+
+def bench_attn_backend(args):
+    '''
+    explicit softmax attention vs. scaled_dot_product_attention, checked for parity
+    '''
+    model = build_model(args)
+    x = random_input(args)
+
+    model.set_attn_backend("math")
+    ref, t_ref = time_forward(model, x, args.repeat)
+    model.set_attn_backend("sdpa")
+    out, t_out = time_forward(model, x, args.repeat)
+
+    for name, a, b in zip(["nuclei", "normal edge", "cluster edge"], ref, out):
+        max_diff = (a - b).abs().max().item()
+        assert torch.allclose(a, b, rtol=1e-4, atol=1e-4), "{} output differs between backends by {}".format(name, max_diff)
+        print("{}: max abs diff {:.2e}".format(name, max_diff))
+    print("attention backend: math {:.4f}s, sdpa {:.4f}s, speed-up {:.2f}x".format(t_ref, t_out, t_ref / t_out))
+
+
+def bench_frozen_bias(args):
+    '''
+    relative position bias gathered on every call vs. the frozen per-block cache
+    '''
+    model = build_model(args)
+    x = random_input(args)
+
+    ref, t_ref = time_forward(model, x, args.repeat)
+    model.freeze_attention_bias()
+    out, t_out = time_forward(model, x, args.repeat)
+
+    for name, a, b in zip(["nuclei", "normal edge", "cluster edge"], ref, out):
+        assert torch.allclose(a, b, rtol=1e-5, atol=1e-5), "{} output differs with the frozen bias".format(name)
+    print("relative position bias: per call {:.4f}s, frozen {:.4f}s".format(t_ref, t_out))
+
+
+def bench_dynamic_shape(args):
+    '''
+    dynamic_shape at a resolution the blocks were not built for (LRU cached shift masks) in reduced precision,
+    checked against float32 for both attention backends
+    '''
+    model = TransNuSeg(img_size=args.img_size, in_chans=args.in_chans, dynamic_shape=True).to(args.device).eval()
+    H, W = args.img_size + model.pad_multiple, args.img_size - model.pad_multiple // 2  # padded back to a multiple
+    x = torch.rand(args.batch_size, args.in_chans, H, W, device=args.device)
+    dtypes = [torch.bfloat16] + ([torch.float16] if x.is_cuda else [])
+    for backend in ("math", "sdpa"):
+        model.set_attn_backend(backend)
+        model.float()
+        ref, t_ref = time_forward(model, x, args.repeat)
+        for dtype in dtypes:
+            model.to(dtype)
+            out, t_out = time_forward(model, x.to(dtype), args.repeat)
+            for name, a, b in zip(HEADS, ref, out):
+                assert b.dtype == dtype and b.shape == a.shape, "{} output has {} {}".format(name, b.dtype, tuple(b.shape))
+                error = ((a - b.float()).norm() / a.norm()).item()
+                assert error < 5e-2, "{} {} output differs from float32 by {:.2e} (relative)".format(backend, name, error)
+            print("{} {}x{} {}: float32 {:.4f}s, {:.4f}s".format(
+                backend, H, W, str(dtype).split(".")[-1], t_ref, t_out))
+
+
+def count_flops(model, x, **kwargs):
+    from torch.utils.flop_counter import FlopCounterMode
+    counter = FlopCounterMode(display=False)
+    with torch.no_grad(), counter:
+        model(x, **kwargs)
+    return counter.get_total_flops()
+
+
+def bench_heads(args):
+    '''
+    FLOPs and latency of every combination of output heads, relative to computing all three
+    '''
+    model = build_model(args)
+    x = random_input(args)
+
+    full_flops = count_flops(model, x)
+    full, t_full = time_forward(model, x, args.repeat)
+    print("{:<40} {:>10} {:>8} {:>10} {:>8}".format("heads", "GFLOPs", "saved", "latency", "saved"))
+    for n in range(1, len(HEADS) + 1):
+        for heads in itertools.combinations(HEADS, n):
+            flops = count_flops(model, x, heads=heads)
+            outputs, t = time_forward(lambda inp: model(inp, heads=heads), x, args.repeat)
+            for name, output in zip(heads, outputs):
+                assert torch.equal(output, full[HEADS.index(name)]), "{} differs when computed alone".format(name)
+            print("{:<40} {:>10.2f} {:>7.1f}% {:>9.4f}s {:>7.1f}%".format(
+                ",".join(heads), flops / 1e9, 100 * (1 - flops / full_flops), t, 100 * (1 - t / t_full)))
+
+
+def bench_shift(args):
+    '''
+    gather based token shift of shiftmlp vs. the pad / chunk / roll / narrow reference on the 16x16x768 bottleneck
+    '''
+    H = W = args.img_size // 32
+    C = 768
+    mlp = shiftmlp(in_features=C, input_resolution=(H, W)).to(args.device)
+    x = torch.randn(args.batch_size, H * W, C, device=args.device)
+    for dim in (2, 3):
+        assert torch.equal(getattr(mlp, "shift_index_{}".format(dim)), get_shift_index(H, W, C, mlp.shift_size, dim, x.device))
+        ref, t_ref = time_forward(lambda inp: mlp.shift_reference(inp, H, W, dim), x, args.repeat * 20)
+        out, t_out = time_forward(lambda inp: mlp.shift(inp, H, W, dim), x, args.repeat * 20)
+        assert torch.equal(ref, out), "shift along dim {} differs from the reference".format(dim)
+        print("shift dim {}: reference {:.2f}ms, gather {:.2f}ms, bit-identical".format(dim, 1e3 * t_ref, 1e3 * t_out))
+
+
+def bench_window_index(args):
+    '''
+    roll + window_partition / window_reverse + roll vs. the precomputed window gather on the 128x128x96 stage
+    '''
+    H = W = args.img_size // 4
+    C, ws = 96, 8
+    x = torch.randn(args.batch_size, H * W, C, device=args.device)
+    B = x.shape[0]
+
+    for shift in (0, ws // 2):
+        index, index_inv = get_window_index(H, W, ws, shift, x.device)
+
+        def reference(inp):
+            inp = torch.roll(inp.view(B, H, W, C), shifts=(-shift, -shift), dims=(1, 2))
+            windows = window_partition(inp, ws).view(-1, ws * ws, C)
+            out = window_reverse(windows.view(-1, ws, ws, C), ws, H, W)
+            return windows, torch.roll(out, shifts=(shift, shift), dims=(1, 2)).view(B, H * W, C)
+
+        def gather(inp):
+            windows = inp.index_select(1, index).view(-1, ws * ws, C)
+            return windows, windows.view(B, H * W, C).index_select(1, index_inv)
+
+        ref, t_ref = time_forward(reference, x, args.repeat * 20)
+        out, t_out = time_forward(gather, x, args.repeat * 20)
+        assert torch.equal(ref[0], out[0]), "window partition with shift {} differs from the reference".format(shift)
+        assert torch.equal(ref[1], out[1]) and torch.equal(out[1], x), "window reverse with shift {} differs".format(shift)
+        print("window shift {}: roll + partition/reverse {:.2f}ms, gather {:.2f}ms, bit-identical".format(
+            shift, 1e3 * t_ref, 1e3 * t_out))
+
+
+def bench_shared_buffers(args):
+    '''
+    resident size of the derived buffers with and without sharing, checkpoint size, and loading an old checkpoint
+    '''
+    model = build_model(args)
+    buffers = [b for _, b in model.named_buffers(remove_duplicate=False)]
+    total = sum(b.numel() * b.element_size() for b in buffers)
+    unique = sum(b.numel() * b.element_size() for b in {b.data_ptr(): b for b in buffers}.values())
+    print("buffers: {:.2f}MB as separate copies, {:.2f}MB resident".format(total / 2 ** 20, unique / 2 ** 20))
+
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    legacy = dict(model.state_dict())
+    for name, b in model.named_buffers(remove_duplicate=False):
+        if name.rsplit(".", 1)[-1] in ("attn_mask", "relative_position_index"):
+            legacy[name] = b.clone()
+    legacy_buf = io.BytesIO()
+    torch.save(legacy, legacy_buf)
+    print("checkpoint: {:.2f}MB, with derived buffers {:.2f}MB".format(
+        buf.tell() / 2 ** 20, legacy_buf.tell() / 2 ** 20))
+
+    model.load_state_dict(legacy)
+    print("checkpoint with derived buffers loads strictly")
+
+
+def bench_checkpoint(args):
+    '''
+    torch.save vs. the compact checkpoint: file size and load time, checked for identical weights
+    '''
+    model = build_model(args)
+    state_dict = model.state_dict()
+    with tempfile.TemporaryDirectory() as tmp:
+        pt_path = os.path.join(tmp, "model.pt")
+        torch.save(state_dict, pt_path)
+        s = time.perf_counter()
+        load_checkpoint(build_model(args), pt_path)
+        t_pt = time.perf_counter() - s
+        print("torch.save: {:.2f}MB, load {:.3f}s".format(os.path.getsize(pt_path) / 2 ** 20, t_pt))
+
+        for dtype in (torch.float32, torch.float16, torch.bfloat16):
+            path = os.path.join(tmp, "model" + COMPACT_SUFFIX)
+            save_compact(state_dict, path, dtype=dtype)
+            target = build_model(args)
+            s = time.perf_counter()
+            load_checkpoint(target, path)
+            t = time.perf_counter() - s
+            for name, tensor in target.state_dict().items():
+                assert torch.equal(tensor, state_dict[name].to(dtype).to(tensor.dtype)), "{} differs".format(name)
+            print("compact {}: {:.2f}MB, load {:.3f}s".format(
+                str(dtype).split(".")[-1], os.path.getsize(path) / 2 ** 20, t))
+
+
+def bench_drop_path(args):
+    '''
+    stochastic depth that multiplies the dropped branches by zero vs. skipping them: gradient parity of one block
+    under the same keep mask, same output and gradients of a shared edge decoder block with the mode on (it keeps
+    the masked DropPath), then the training step time at the model's drop_path_rate
+    '''
+    model = build_model(args)
+    block = model.layers[0].blocks[-1]
+    x = torch.rand(max(args.batch_size, 4), block.input_resolution[0] * block.input_resolution[1], block.dim,
+                   device=args.device, requires_grad=True)
+    block.drop_path.drop_prob = 0.5
+    torch.manual_seed(1)
+    keep = (torch.rand(x.shape[0]) < 0.5).to(x.device)
+    ref = x + block.attn_branch(x, *block.input_resolution) * keep.view(-1, 1, 1) / 0.5
+    ref_grads = torch.autograd.grad(ref.square().sum(), [x] + list(block.parameters()), allow_unused=True)
+    torch.manual_seed(1)
+    out = drop_path_residual(x, lambda y: block.attn_branch(y, *block.input_resolution), block.drop_path)
+    grads = torch.autograd.grad(out.square().sum(), [x] + list(block.parameters()), allow_unused=True)
+    diff = max([(out - ref).abs().max().item()] + [(r if g is None else g - r).abs().max().item()
+                                                     for g, r in zip(grads, ref_grads) if r is not None])
+    print("skip vs. mask ({} of {} samples kept): max abs diff {:.2e}".format(int(keep.sum()), x.shape[0], diff))
+    assert diff < 1e-4, "skipped drop path differs by {}".format(diff)
+
+    block = next(m for m in itertools.chain(model.layers_up2.modules(), model.layers_up3.modules())
+                 if isinstance(m, Shared_SwinTransformerBlock) and hasattr(m.drop_path, "drop_prob"))
+    block.drop_path.drop_prob = 0.5
+    block.train()
+    x = torch.rand(max(args.batch_size, 2), block.input_resolution[0] * block.input_resolution[1], block.dim,
+                   device=args.device, requires_grad=True)
+    results = []
+    for skip in (False, True):
+        model.set_skip_dropped_paths(skip)
+        torch.manual_seed(1)
+        out = block(x)
+        results.append((out,) + torch.autograd.grad(out.square().sum(), [x] + list(block.parameters()),
+                                                     allow_unused=True))
+    model.set_skip_dropped_paths(False)
+    diff = max((a - b).abs().max().item() for a, b in zip(*results) if a is not None)
+    print("shared edge decoder block, skip mode vs. mask: max abs diff {:.2e}".format(diff))
+    assert diff < 1e-6, "shared block differs in skip mode by {}".format(diff)
+
+    model = build_model(args)
+    x = random_input(args)
+    t_ref = time_train_step(model, x, args.repeat)
+    model.set_skip_dropped_paths(True)
+    t_out = time_train_step(model, x, args.repeat)
+    print("train step: mask {:.4f}s, skip {:.4f}s, speed-up {:.2f}x".format(t_ref, t_out, t_ref / t_out))
+
+
+def bench_edge(args):
+    '''
+    distillation edges of the predicted nuclei: argmax, host copy and cv2 contours (utils.edge_detection) vs. the
+    max / min pool morphological gradient on the device, Dice agreement of the edge maps and time per step
+    '''
+    batch_size = max(args.batch_size, 2)
+    # blob shaped nuclei logits: smoothed noise
+    noise = F.avg_pool2d(torch.rand(batch_size, 1, args.img_size, args.img_size, device=args.device), 15, 1, 7)
+    logits = torch.cat([0.5 - noise, noise - 0.5], 1) * 100
+
+    def cv2_edges():
+        m = torch.argmax(logits, dim=1)
+        return torch.tensor(edge_detection(m.cpu().numpy())).to(args.device).float()
+
+    def torch_edges():
+        return edge_detection_torch(torch.argmax(logits, dim=1))
+
+    timings = {}
+    for name, fn in (("cv2", cv2_edges), ("torch", torch_edges)):
+        edges = fn()
+        if logits.is_cuda:
+            torch.cuda.synchronize()
+        s = time.perf_counter()
+        for _ in range(args.repeat):
+            edges = fn()
+        if logits.is_cuda:
+            torch.cuda.synchronize()
+        timings[name] = ((time.perf_counter() - s) / args.repeat, edges)
+    (t_ref, ref), (t_out, out) = timings["cv2"], timings["torch"]
+    agreement = 2 * (ref * out).sum().item() / (ref.sum() + out.sum()).item()
+    print("edge maps: cv2 {} px, torch {} px, Dice {:.4f}".format(int(ref.sum()), int(out.sum()), agreement))
+    print("edges per step: cv2 {:.4f}s, torch {:.4f}s, speed-up {:.2f}x".format(t_ref, t_out, t_ref / t_out))
+
+
+def bench_loss(args):
+    '''
+    CE + Dice of the three heads as three CrossEntropyLoss / DiceLoss pairs (as train.py did) vs. the fused
+    MultiHeadDiceCELoss, checked for the same loss and gradients, time of forward and backward
+    '''
+    num_classes, head_weights = 2, (0.3, 0.35, 0.35)
+    logits = torch.randn(len(HEADS), args.batch_size, num_classes, args.img_size, args.img_size, device=args.device,
+                         requires_grad=True)
+    target = torch.randint(0, num_classes, (len(HEADS), args.batch_size, args.img_size, args.img_size),
+                           device=args.device, dtype=torch.uint8)
+    ce, dice = torch.nn.CrossEntropyLoss(), DiceLoss(num_classes)
+    fused = MultiHeadDiceCELoss(num_classes, head_weights).to(args.device)
+
+    def separate():
+        return sum(w * (0.4 * ce(logits[h], target[h].long()) + 0.6 * dice(logits[h], target[h].float(), softmax=True))
+                   for h, w in enumerate(head_weights))
+
+    timings = {}
+    for name, fn in (("separate", separate), ("fused", lambda: fused(logits, target)[0])):
+        for i in range(1 + args.repeat):
+            if i == 1:
+                if logits.is_cuda:
+                    torch.cuda.synchronize()
+                s = time.perf_counter()
+            logits.grad = None
+            loss = fn()
+            loss.backward()
+        if logits.is_cuda:
+            torch.cuda.synchronize()
+        timings[name] = ((time.perf_counter() - s) / args.repeat, loss.detach(), logits.grad.clone())
+    (t_ref, ref, ref_grad), (t_out, out, out_grad) = timings["separate"], timings["fused"]
+    diff = max((out - ref).abs().item(), (out_grad - ref_grad).abs().max().item())
+    print("loss {:.6f} vs {:.6f}, max abs diff {:.2e}".format(ref.item(), out.item(), diff))
+    assert diff < 1e-5, "fused loss differs by {}".format(diff)
+    print("loss forward + backward: separate {:.4f}s, fused {:.4f}s, speed-up {:.2f}x".format(t_ref, t_out, t_ref / t_out))
+
+
+def bench_fuse(args):
+    '''
+    model as trained vs. fuse_for_inference (folded scale / LayerNorm affine, split concat linears, frozen bias)
+    '''
+    model = build_model(args)
+    x = random_input(args)
+    fused, report = model.fuse_for_inference(x)
+    print(report)
+    assert report["parity"], "fused model differs by {}".format(report["max_abs_diff"])
+
+    _, t_ref = time_forward(model, x, args.repeat)
+    _, t_out = time_forward(fused, x, args.repeat)
+    print("fuse for inference: reference {:.4f}s, fused {:.4f}s, speed-up {:.2f}x".format(t_ref, t_out, t_ref / t_out))
+
+
+def bench_compile(args):
+    '''
+    checks that the model is captured as one graph (no graph breaks, torch.export works) and compares eager
+    with torch.compile(fullgraph=True) throughput
+    '''
+    model = build_model(args)
+    x = random_input(args)
+
+    explanation = torch._dynamo.explain(model)(x)
+    assert explanation.graph_break_count == 0, "graph breaks: {}".format(explanation.break_reasons)
+    print("dynamo: {} graph, {} graph breaks".format(explanation.graph_count, explanation.graph_break_count))
+
+    with torch.no_grad():
+        exported = torch.export.export(model, (x,))
+        for name, a, b in zip(HEADS, model(x), exported.module()(x)):
+            assert torch.allclose(a, b, rtol=1e-4, atol=1e-4), "{} differs in the exported program".format(name)
+    # the shift / window indices and masks are buffers at the native resolution, none is rebuilt in the graph
+    index_builds = [node for node in exported.graph.nodes if node.op == "call_function" and "arange" in str(node.target)]
+    assert not index_builds, "index construction traced into the graph: {}".format(index_builds)
+    print("torch.export: ok, no index construction in the graph")
+
+    compiled = torch.compile(model, fullgraph=True)
+    ref, t_ref = time_forward(model, x, args.repeat)
+    out, t_out = time_forward(compiled, x, args.repeat, warmup=2)
+    for name, a, b in zip(HEADS, ref, out):
+        assert torch.allclose(a, b, rtol=1e-3, atol=1e-3), "{} differs when compiled".format(name)
+    print("eager {:.2f} img/s, compiled {:.2f} img/s, speed-up {:.2f}x".format(
+        args.batch_size / t_ref, args.batch_size / t_out, t_ref / t_out))
+
+
+def bench_onnx(args):
+    '''
+    eager PyTorch vs. the exported ONNX graph in onnx_inference.OnnxPredictor: logit parity (also at other batch
+    sizes, the batch axis is dynamic: 3 and 9 make num_windows*B cross the shared window split of the 32x32 and
+    16x16 edge decoder stages) and latency
+    '''
+    from onnx_export import export_onnx
+    from onnx_inference import OnnxPredictor
+
+    model = build_model(args)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = export_onnx(model, os.path.join(tmp, "model.onnx"), args.img_size, args.in_chans)
+        predictor = OnnxPredictor(path)
+        for batch_size in sorted({args.batch_size, args.batch_size + 1, 3, 9}):
+            x = torch.rand(batch_size, args.in_chans, args.img_size, args.img_size, device=args.device)
+            with torch.no_grad():
+                ref = model(x)
+            out = predictor(x.cpu().numpy())
+            for name, a, b in zip(HEADS, ref, out):
+                max_diff = (a.cpu() - torch.from_numpy(b)).abs().max().item()
+                assert max_diff < 1e-3, "{} differs by {} at batch size {}".format(name, max_diff, batch_size)
+            print("batch size {}: logits match, max abs diff {:.2e}".format(batch_size, max_diff))
+
+        x = random_input(args)
+        _, t_ref = time_forward(model, x, args.repeat)
+        x = x.cpu().numpy()
+        predictor(x)
+        s = time.perf_counter()
+        for _ in range(args.repeat):
+            predictor(x)
+        t_out = (time.perf_counter() - s) / args.repeat
+    print("eager {:.4f}s, onnxruntime {:.4f}s, speed-up {:.2f}x".format(t_ref, t_out, t_ref / t_out))
+
+
+def sparse_field(args, density, radius=8, background=0.9, foreground=0.3):
+    '''
+    synthetic field: flat background with dark disks ("nuclei") covering about density of the image
+    '''
+    size = args.img_size
+    yy, xx = torch.meshgrid(torch.arange(size), torch.arange(size), indexing="ij")
+    images = torch.full((args.batch_size, args.in_chans, size, size), background)
+    count = int(density * size * size / (math.pi * radius ** 2))
+    for b in range(args.batch_size):
+        for y, x in torch.randint(radius, size - radius, (count, 2)).tolist():
+            disk = (yy - y) ** 2 + (xx - x) ** 2 <= radius ** 2
+            images[b, :, disk] = foreground
+    return images.to(args.device)
+
+
+def bench_sparse(args):
+    '''
+    dense vs. sparse window mode on synthetic fields of increasing nuclei density: latency, share of active
+    windows and agreement of the nuclei masks
+    '''
+    model = build_model(args)
+    print("{:>8} {:>8} {:>10} {:>10} {:>9} {:>10}".format("density", "active", "dense", "sparse", "speed-up", "agreement"))
+    for density in (0.0, 0.02, 0.05, 0.1, 0.2, 0.5):
+        x = sparse_field(args, density)
+        model.set_sparse_windows(None)
+        ref, t_ref = time_forward(model, x, args.repeat)
+        model.set_sparse_windows(0.1)
+        out, t_out = time_forward(model, x, args.repeat)
+        with torch.no_grad():
+            active = model.active_tokens(x)[tuple(model.patches_resolution)].float().mean().item()
+        agreement = (ref[0].argmax(1) == out[0].argmax(1)).float().mean().item()
+        print("{:>8.2f} {:>7.1f}% {:>9.4f}s {:>9.4f}s {:>8.2f}x {:>9.1f}%".format(
+            density, 100 * active, t_ref, t_out, t_ref / t_out, 100 * agreement))
+    model.set_sparse_windows(None)
+
+
+BENCHMARKS = {
+    "attn_backend": bench_attn_backend,
+    "checkpoint": bench_checkpoint,
+    "compile": bench_compile,
+    "drop_path": bench_drop_path,
+    "dynamic_shape": bench_dynamic_shape,
+    "edge": bench_edge,
+    "edge_trunk": bench_edge_trunk,
+    "frozen_bias": bench_frozen_bias,
+    "fuse": bench_fuse,
+    "heads": bench_heads,
+    "loss": bench_loss,
+    "onnx": bench_onnx,
+    "shared_buffers": bench_shared_buffers,
+    "shift": bench_shift,
+    "sparse": bench_sparse,
+    "window_index": bench_window_index,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS), help="which benchmark to run")
+    parser.add_argument("--img_size", type=int, default=512, help="input image size")
+    parser.add_argument("--in_chans", type=int, default=3, help="number of input channels")
+    parser.add_argument("--batch_size", type=int, default=1, help="batch size")
+    parser.add_argument("--repeat", type=int, default=5, help="number of timed runs")
+    parser.add_argument("--device", default='cuda:0' if torch.cuda.is_available() else 'cpu', help="device to run on")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,13 +9,21 @@ import cv2
 from PIL import Image
 from torchvision import transforms
 
-device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
 
 
+def to_float_image(img):
+    '''
+    float image in [0, 1] from the uint8 images returned by MyDataset (images already in float are kept)
+    '''
+    return img.float().div_(255) if img.dtype == torch.uint8 else img.float()
+
 
 class MyDataset(Dataset):
     '''
     dir_path: path to data, having two folders named data and label respectively
+    returns CPU tensors, so the dataset can be read by DataLoader workers into pinned memory: the image as uint8
+    C, H, W (see to_float_image, unless a transform is given) and the instance, semantic, normal edge and cluster
+    edge masks as uint8 H, W
     '''
     def __init__(self,dir_path,transform = None,in_chan = 3): 
         self.dir_path = dir_path
@@ -57,17 +65,12 @@ class MyDataset(Dataset):
             img = self.transform(img)
             label = self.transform(label)
         else:
-            T = transforms.Compose([
-                transforms.ToTensor()
-            ])
-            img = T(img)
-            img = img
-            semantic_mask = torch.tensor(semantic_mask)
-        img = img.to(device)
-        semantic_mask = semantic_mask.to(device)
-        instance_mask = torch.tensor(instance_mask).to(device)
-        normal_edge_mask = torch.tensor(normal_edge_mask).to(device)
-        cluster_edge_mask = torch.tensor(cluster_edge_mask).to(device)
+            img = np.asarray(img)
+            img = torch.from_numpy(img.transpose(2, 0, 1).copy() if img.ndim == 3 else img[None].copy())
+            semantic_mask = torch.from_numpy(semantic_mask)
+        instance_mask = torch.from_numpy(instance_mask)
+        normal_edge_mask = torch.from_numpy(normal_edge_mask)
+        cluster_edge_mask = torch.from_numpy(cluster_edge_mask)
         return img,instance_mask,semantic_mask, normal_edge_mask,cluster_edge_mask
     
     def __len__(self):
@@ -111,3 +114,45 @@ class MyDataset(Dataset):
 
         return cluster_edge_mask
 
+
+class DevicePrefetcher:
+    '''
+    iterates over a DataLoader of MyDataset batches and hands them out on the device with the image converted by
+    to_float_image. On CUDA the next batch is copied (asynchronously from pinned memory) and converted on a side
+    stream while the current step runs.
+    '''
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, batch):
+        img, *masks = batch
+        img = to_float_image(img.to(self.device, non_blocking=True))
+        return [img] + [m.to(self.device, non_blocking=True) for m in masks]
+
+    def _preload(self, batches):
+        batch = next(batches, None)
+        if batch is None:
+            return None
+        with torch.cuda.stream(self.stream):
+            return self._to_device(batch)
+
+    def __iter__(self):
+        if self.stream is None:
+            for batch in self.loader:
+                yield self._to_device(batch)
+            return
+        batches = iter(self.loader)
+        next_batch = self._preload(batches)
+        while next_batch is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(self.stream)
+            batch = next_batch
+            for t in batch:
+                t.record_stream(current)
+            next_batch = self._preload(batches)
+            yield batch
@@ -0,0 +1,150 @@
+'''
+Compact checkpoints for TransNuSeg.
+
+The decoders of the two edge heads share most of their modules (layers_up2 / layers_up3, concat_back_dim2 /
+concat_back_dim3), so a plain state_dict holds the same tensor under several names. save_compact writes every
+tensor once, in the safetensors layout (8 byte little endian header size, JSON header, raw data), and records the
+other names as aliases in the header metadata. load_compact maps the file instead of deserialising it, so loading
+costs page faults only.
+
+    save_compact(model.state_dict(), "model.safetensors", dtype=torch.float16)
+    load_compact_into(model, "model.safetensors")
+'''
+import inspect
+import json
+import struct
+
+import numpy as np
+import torch
+
+
+COMPACT_SUFFIX = ".safetensors"
+HEADER_ALIGNMENT = 8
+
+# safetensors dtype names, numpy has no bfloat16 so it is stored and mapped as int16
+DTYPES = {
+    torch.float64: ("F64", np.float64),
+    torch.float32: ("F32", np.float32),
+    torch.float16: ("F16", np.float16),
+    torch.bfloat16: ("BF16", np.int16),
+    torch.int64: ("I64", np.int64),
+    torch.int32: ("I32", np.int32),
+    torch.int16: ("I16", np.int16),
+    torch.int8: ("I8", np.int8),
+    torch.uint8: ("U8", np.uint8),
+    torch.bool: ("BOOL", np.bool_),
+}
+TORCH_DTYPES = {name: dtype for dtype, (name, _) in DTYPES.items()}
+
+
+def alias_key(tensor):
+    return tensor.device, tensor.data_ptr(), tensor.dtype, tuple(tensor.shape), tensor.stride()
+
+
+def save_compact(state_dict, path, dtype=None, metadata=None):
+    '''
+    state_dict: e.g. model.state_dict(), tensors under several names are written once
+    dtype: None to keep the dtypes, or torch.float16 / torch.bfloat16 to store floating point tensors at half size
+    metadata: optional dict of str -> str stored in the header
+    '''
+    tensors, aliases, names = {}, {}, {}
+    for name, tensor in state_dict.items():
+        key = alias_key(tensor)
+        if key in names:
+            aliases[name] = names[key]
+            continue
+        names[key] = name
+        tensor = tensor.detach().cpu()
+        if dtype is not None and tensor.is_floating_point():
+            tensor = tensor.to(dtype)
+        tensors[name] = tensor.contiguous()
+
+    # largest elements first, so every tensor starts aligned to its element size
+    order = sorted(tensors, key=lambda name: -tensors[name].element_size())
+    header, offset = {}, 0
+    for name in order:
+        tensor = tensors[name]
+        nbytes = tensor.numel() * tensor.element_size()
+        header[name] = {"dtype": DTYPES[tensor.dtype][0], "shape": list(tensor.shape),
+                        "data_offsets": [offset, offset + nbytes]}
+        offset += nbytes
+    meta = dict(metadata or {})
+    meta["aliases"] = json.dumps(aliases)
+    header["__metadata__"] = meta
+
+    header = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header += b" " * (-(8 + len(header)) % HEADER_ALIGNMENT)
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for name in order:
+            tensor = tensors[name]
+            if tensor.dtype == torch.bfloat16:
+                tensor = tensor.view(torch.int16)
+            f.write(tensor.numpy().tobytes())
+
+
+def read_header(path):
+    with open(path, "rb") as f:
+        n = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(n))
+    return header, 8 + n
+
+
+def load_compact(path):
+    '''
+    returns the state_dict of a compact checkpoint, tensors are copy-on-write views of the memory mapped file and
+    aliases point at the same tensor
+    '''
+    header, data_start = read_header(path)
+    metadata = header.pop("__metadata__", {})
+    data = np.memmap(path, dtype=np.uint8, mode="c", offset=data_start) if header else None
+    state_dict = {}
+    for name, info in header.items():
+        dtype = TORCH_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        array = data[begin:end].view(DTYPES[dtype][1]).reshape(info["shape"])
+        tensor = torch.from_numpy(array)
+        if dtype == torch.bfloat16:
+            tensor = tensor.view(torch.bfloat16)
+        state_dict[name] = tensor
+    for name, target in json.loads(metadata.get("aliases", "{}")).items():
+        state_dict[name] = state_dict[target]
+    return state_dict
+
+
+def supports_assign():
+    # load_state_dict(assign=True) exists from torch 2.1 on
+    return "assign" in inspect.signature(torch.nn.Module.load_state_dict).parameters
+
+
+def load_compact_into(model, path, strict=True):
+    '''
+    loads a compact checkpoint without copying: tensors already in the model's dtype are assigned as they are
+    (memory mapped), the others are cast. Shared modules end up holding the same tensor again.
+    Before torch 2.1 (no assign) the tensors are copied into the model's parameters instead.
+    '''
+    state_dict = load_compact(path)
+    if not supports_assign():
+        return model.load_state_dict(state_dict, strict=strict)
+    current = model.state_dict()
+    cast = {}
+    for name, tensor in state_dict.items():
+        if name in current and tensor.dtype != current[name].dtype:
+            key = alias_key(tensor)
+            if key not in cast:
+                cast[key] = tensor.to(current[name].dtype)
+            state_dict[name] = cast[key]
+    return model.load_state_dict(state_dict, strict=strict, assign=True)
+
+
+def load_checkpoint(model, path, map_location=None, strict=True):
+    '''
+    loads either a compact checkpoint (by its suffix) or a torch.save'd state_dict
+    '''
+    if path.endswith(COMPACT_SUFFIX):
+        result = load_compact_into(model, path, strict=strict)
+        if map_location is not None:
+            model.to(map_location)
+        return result
+    return model.load_state_dict(torch.load(path, map_location=map_location), strict=strict)
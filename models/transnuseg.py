@@ -8,7 +8,6 @@ from torch.nn.modules.utils import _pair
 from scipy import ndimage
 
 import torch.utils.checkpoint as checkpoint
-from einops import rearrange
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
 
 import torch.optim as optim
@@ -17,6 +16,8 @@ import torch.utils.data as data
 import scipy.io as sio
 import matplotlib.pyplot as plt
 import copy
+import functools
+import weakref
 import logging
 import math
 import torch.nn.functional as F
@@ -30,15 +31,43 @@ def conv1x1(in_planes: int, out_planes: int, stride: int = 1) -> nn.Conv2d:
     return nn.Conv2d(in_planes, out_planes, kernel_size=1, stride=1, bias=False)
 
 
-def shift(dim):
-            x_shift = [ torch.roll(x_c, shift, dim) for x_c, shift in zip(xs, range(-self.pad, self.pad+1))]
-            x_cat = torch.cat(x_shift, 1)
-            x_cat = torch.narrow(x_cat, 2, self.pad, H)
-            x_cat = torch.narrow(x_cat, 3, self.pad, W)
-            return x_cat
+def compute_shift_index(H, W, C, shift_size, dim):
+    """
+    Gather index equivalent to the pad / chunk / roll / narrow token shift of shiftmlp: channel group g of
+    torch.chunk(x, shift_size, 1) is shifted by g - shift_size // 2 along dim (2: H, 3: W) with zero fill.
+    Args:
+        H, W (int): resolution of the feature map
+        C (int): number of channels
+        shift_size (int): number of channel groups
+        dim (int): 2 to shift along H, 3 to shift along W
+    Returns:
+        index: (H*W, C) token index into the B, H*W+1, C features whose last token is zero
+    """
+    pad = shift_size // 2
+    chunk = -(-C // shift_size)  # channels per group, as in torch.chunk
+    shifts = torch.arange(C) // chunk - pad  # C
+    h = torch.arange(H).view(H, 1, 1)
+    w = torch.arange(W).view(1, W, 1)
+    if dim == 2:
+        h = h - shifts
+    else:
+        w = w - shifts
+    valid = (h >= 0) & (h < H) & (w >= 0) & (w < W)
+    index = torch.where(valid, h * W + w, torch.full_like(h * W + w, H * W))  # H, W, C
+    return index.view(H * W, C)
+
+
+@functools.lru_cache(maxsize=32)
+def get_shift_index(H, W, C, shift_size, dim, device):
+    """
+    LRU cached compute_shift_index on the given device, only used for resolutions other than the one a shiftmlp
+    was built for (dynamic_shape).
+    """
+    return compute_shift_index(H, W, C, shift_size, dim).to(device)
 
 class shiftmlp(nn.Module):
-    def __init__(self, in_features, hidden_features=None, out_features=None, act_layer=nn.GELU, drop=0., shift_size=5):
+    def __init__(self, in_features, hidden_features=None, out_features=None, act_layer=nn.GELU, drop=0., shift_size=5,
+                 input_resolution=None):
         super().__init__()
         out_features = out_features or in_features
         hidden_features = hidden_features or in_features
@@ -52,6 +81,15 @@ class shiftmlp(nn.Module):
         self.shift_size = shift_size
         self.pad = shift_size // 2
 
+        # gather indices of the two token shifts at the resolution the block is built for, so the forward at that
+        # resolution only reads buffers (no cache lookups or index construction in a captured graph)
+        self.input_resolution = input_resolution
+        if input_resolution is not None:
+            H, W = input_resolution
+            for dim, C in ((2, in_features), (3, hidden_features)):
+                key = ("shift_index", H, W, C, shift_size, dim)
+                register_shared_buffer(self, f"shift_index_{dim}", key, compute_shift_index(H, W, C, shift_size, dim))
+
         
         self.apply(self._init_weights)
 
@@ -69,30 +107,41 @@ class shiftmlp(nn.Module):
             m.weight.data.normal_(0, math.sqrt(2.0 / fan_out))
             if m.bias is not None:
                 m.bias.data.zero_()
-    
-#     def shift(x, dim):
-#         x = F.pad(x, "constant", 0)
-#         x = torch.chunk(x, shift_size, 1)
-#         x = [ torch.roll(x_c, shift, dim) for x_s, shift in zip(x, range(-pad, pad+1))]
-#         x = torch.cat(x, 1)
-#         return x[:, :, pad:-pad, pad:-pad]
 
-    def forward(self, x, H, W):
-        # pdb.set_trace()
+    def shift(self, x, H, W, dim):
+        """
+        Token shift as a single gather, with the registered index at the resolution the block was built for and a
+        cached one otherwise.
+        Args:
+            x: B, H*W, C
+            dim (int): 2 to shift along H, 3 to shift along W
+        """
         B, N, C = x.shape
+        if self.input_resolution is not None and (H, W) == tuple(self.input_resolution):
+            index = getattr(self, f"shift_index_{dim}")
+        else:
+            index = get_shift_index(H, W, C, self.shift_size, dim, x.device)
+        x = F.pad(x, (0, 0, 0, 1))  # zero token that out-of-range positions read from
+        return torch.gather(x, 1, index.unsqueeze(0).expand(B, -1, -1))
 
+    def shift_reference(self, x, H, W, dim):
+        """
+        The pad / chunk / roll / narrow formulation of shift, kept as the reference for parity checks.
+        """
+        B, N, C = x.shape
         xn = x.transpose(1, 2).view(B, C, H, W).contiguous()
         xn = F.pad(xn, (self.pad, self.pad, self.pad, self.pad) , "constant", 0)
         xs = torch.chunk(xn, self.shift_size, 1)
-        x_shift = [torch.roll(x_c, shift, 2) for x_c, shift in zip(xs, range(-self.pad, self.pad+1))]
+        x_shift = [torch.roll(x_c, shift, dim) for x_c, shift in zip(xs, range(-self.pad, self.pad+1))]
         x_cat = torch.cat(x_shift, 1)
         x_cat = torch.narrow(x_cat, 2, self.pad, H)
         x_s = torch.narrow(x_cat, 3, self.pad, W)
-
-
         x_s = x_s.reshape(B,C,H*W).contiguous()
-        x_shift_r = x_s.transpose(1,2)
+        return x_s.transpose(1,2)
 
+    def forward(self, x, H, W):
+        # pdb.set_trace()
+        x_shift_r = self.shift(x, H, W, 2)
 
         x = self.fc1(x_shift_r)
 
@@ -100,15 +149,7 @@ class shiftmlp(nn.Module):
         x = self.act(x) 
         x = self.drop(x)
 
-        xn = x.transpose(1, 2).view(B, C, H, W).contiguous()
-        xn = F.pad(xn, (self.pad, self.pad, self.pad, self.pad) , "constant", 0)
-        xs = torch.chunk(xn, self.shift_size, 1)
-        x_shift = [torch.roll(x_c, shift, 3) for x_c, shift in zip(xs, range(-self.pad, self.pad+1))]
-        x_cat = torch.cat(x_shift, 1)
-        x_cat = torch.narrow(x_cat, 2, self.pad, H)
-        x_s = torch.narrow(x_cat, 3, self.pad, W)
-        x_s = x_s.reshape(B,C,H*W).contiguous()
-        x_shift_c = x_s.transpose(1,2)
+        x_shift_c = self.shift(x, H, W, 3)
 
         x = self.fc2(x_shift_c)
         x = self.drop(x)
@@ -118,15 +159,19 @@ class shiftmlp(nn.Module):
 
 class shiftedBlock(nn.Module):
     def __init__(self, dim, num_heads, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop=0., attn_drop=0.,
-                 drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm, sr_ratio=1,input_resolution=(1,1)):
+                 drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm, sr_ratio=1,input_resolution=(1,1),
+                 use_checkpoint=False):
         super().__init__()
+        self.use_checkpoint = use_checkpoint
 
         # print("shifted Block drop path",drop_path)
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
+        self.skip_dropped_paths = False
         self.norm2 = norm_layer(dim)
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.H,self.W = input_resolution
-        self.mlp = shiftmlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
+        self.mlp = shiftmlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop,
+                            input_resolution=input_resolution)
         self.apply(self._init_weights)
 
     def _init_weights(self, m):
@@ -144,12 +189,21 @@ class shiftedBlock(nn.Module):
             if m.bias is not None:
                 m.bias.data.zero_()
 
-    def forward(self, x):
+    def forward(self, x, H=None, W=None):
         # print("shifted block input x shape",x.shape)
-
-        x = x + self.drop_path(self.mlp(self.norm2(x), self.H, self.W))
+        if H is None:
+            H, W = self.H, self.W
+
+        if self.use_checkpoint:
+            return x + self.drop_path(checkpoint.checkpoint(self.mlp_branch, x, H, W))
+        if self.skip_dropped_paths and self.training:
+            return drop_path_residual(x, functools.partial(self.mlp_branch, H=H, W=W), self.drop_path)
+        x = x + self.drop_path(self.mlp_branch(x, H, W))
         return x
 
+    def mlp_branch(self, x, H, W):
+        return self.mlp(self.norm2(x), H, W)
+
 
 class DWConv(nn.Module):
     def __init__(self, dim=768):
@@ -209,11 +263,350 @@ def window_reverse(windows, window_size, H, W):
     Returns:
         x: (B, H, W, C)
     """
-    B = int(windows.shape[0] / (H * W / window_size / window_size))
+    B = windows.shape[0] // ((H // window_size) * (W // window_size))
     x = windows.view(B, H // window_size, W // window_size, window_size, window_size, -1)
     x = x.permute(0, 1, 3, 2, 4, 5).contiguous().view(B, H, W, -1)
     return x
 
+# derived, read-only buffers shared by every module with the same geometry, see register_shared_buffer
+SHARED_BUFFERS = weakref.WeakValueDictionary()
+DERIVED_BUFFERS = ("attn_mask", "relative_position_index", "window_index", "window_index_inv", "shift_index_2",
+                   "shift_index_3")
+
+
+def shared_buffer(key, tensor):
+    """
+    Interns a derived buffer: the first tensor registered for (key, device, dtype) is returned for all later ones.
+    Entries live as long as some module still holds them.
+    """
+    key = key + (tensor.device, tensor.dtype)
+    shared = SHARED_BUFFERS.get(key)
+    if shared is None:
+        SHARED_BUFFERS[key] = shared = tensor
+    return shared
+
+
+def register_shared_buffer(module, name, key, tensor):
+    """
+    Registers a buffer that is fully determined by key (e.g. resolution, window and shift size). Blocks with the
+    same geometry hold one tensor, which must therefore never be modified in place. The buffer is left out of the
+    state_dict since it is rebuilt by the constructor.
+    """
+    if "shared_buffer_keys" not in module.__dict__:
+        module.shared_buffer_keys = {}
+    module.shared_buffer_keys[name] = key
+    module.register_buffer(name, None if tensor is None else shared_buffer(key, tensor), persistent=False)
+
+
+def intern_shared_buffers(model):
+    """
+    Re-shares the derived buffers after Module._apply (.to(), .cuda(), .half(), ...) gave every module its own copy.
+    """
+    for m in model.modules():
+        for name, key in m.__dict__.get("shared_buffer_keys", {}).items():
+            if m._buffers.get(name) is not None:
+                m._buffers[name] = shared_buffer(key, m._buffers[name])
+    return model
+
+
+def compute_relative_position_index(window_size):
+    """
+    Args:
+        window_size (tuple[int]): height and width of the window
+    Returns:
+        relative_position_index: (Wh*Ww, Wh*Ww) index into the relative position bias table
+    """
+    coords_h = torch.arange(window_size[0])
+    coords_w = torch.arange(window_size[1])
+    coords = torch.stack(torch.meshgrid([coords_h, coords_w]))  # 2, Wh, Ww
+    coords_flatten = torch.flatten(coords, 1)  # 2, Wh*Ww
+    relative_coords = coords_flatten[:, :, None] - coords_flatten[:, None, :]  # 2, Wh*Ww, Wh*Ww
+    relative_coords = relative_coords.permute(1, 2, 0).contiguous()  # Wh*Ww, Wh*Ww, 2
+    relative_coords[:, :, 0] += window_size[0] - 1  # shift to start from 0
+    relative_coords[:, :, 1] += window_size[1] - 1
+    relative_coords[:, :, 0] *= 2 * window_size[1] - 1
+    return relative_coords.sum(-1)  # Wh*Ww, Wh*Ww
+
+
+def compute_attn_mask(H, W, window_size, shift_size):
+    """
+    Args:
+        H, W (int): resolution of the feature map
+        window_size (int): window size
+        shift_size (int): shift size for SW-MSA
+    Returns:
+        attn_mask: (0/-100) mask with shape of (num_windows, window_size*window_size, window_size*window_size),
+            None if the windows are not shifted
+    """
+    if shift_size == 0:
+        return None
+    img_mask = torch.zeros((1, H, W, 1))  # 1 H W 1
+    h_slices = (slice(0, -window_size),
+                slice(-window_size, -shift_size),
+                slice(-shift_size, None))
+    w_slices = (slice(0, -window_size),
+                slice(-window_size, -shift_size),
+                slice(-shift_size, None))
+    cnt = 0
+    for h in h_slices:
+        for w in w_slices:
+            img_mask[:, h, w, :] = cnt
+            cnt += 1
+
+    mask_windows = window_partition(img_mask, window_size)  # nW, window_size, window_size, 1
+    mask_windows = mask_windows.view(-1, window_size * window_size)
+    attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
+    attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
+    return attn_mask
+
+
+@functools.lru_cache(maxsize=32)
+def get_attn_mask(H, W, window_size, shift_size, device):
+    """
+    LRU cached compute_attn_mask on the given device, used for resolutions other than the one a block was built for.
+    """
+    attn_mask = compute_attn_mask(H, W, window_size, shift_size)
+    return None if attn_mask is None else attn_mask.to(device)
+
+
+def compute_window_index(H, W, window_size, shift_size):
+    """
+    Token order <-> shifted-window order, replacing torch.roll + window_partition and window_reverse + torch.roll.
+    Args:
+        H, W (int): resolution of the feature map
+        window_size (int): window size
+        shift_size (int): shift size for SW-MSA
+    Returns:
+        index: (H*W,) x_windows = x.index_select(1, index) is in window_partition order of the rolled map
+        index_inv: (H*W,) inverse permutation bringing the windows back to token order
+    """
+    index = torch.arange(H * W).view(1, H, W, 1)
+    if shift_size > 0:
+        index = torch.roll(index, shifts=(-shift_size, -shift_size), dims=(1, 2))
+    index = window_partition(index, window_size).reshape(-1)
+    return index, torch.argsort(index)
+
+
+@functools.lru_cache(maxsize=32)
+def get_window_index(H, W, window_size, shift_size, device):
+    index, index_inv = compute_window_index(H, W, window_size, shift_size)
+    return index.to(device), index_inv.to(device)
+
+
+def block_window_index(block, H, W, device):
+    """
+    Window gather indices of a Swin block for an H x W input, registered buffers at the resolution the block was
+    built for, LRU cached otherwise (only reached with dynamic_shape).
+    """
+    if (H, W) == tuple(block.input_resolution):
+        return block.window_index, block.window_index_inv
+    return get_window_index(H, W, block.window_size, block.shift_size, device)
+
+
+def window_attn_mask(block, H, W, device):
+    """
+    Shift mask of a Swin block for an H x W input: the registered (or frozen) buffer at the resolution the block
+    was built for, the LRU cached mask otherwise (only reached with dynamic_shape).
+    """
+    if (H, W) == tuple(block.input_resolution):
+        if getattr(block, "frozen_attn_mask", None) is not None:
+            return block.frozen_attn_mask
+        return block.attn_mask
+    return get_attn_mask(H, W, block.window_size, block.shift_size, device)
+
+
+ATTN_BACKENDS = ("math", "sdpa")
+HEADS = ("nuclei", "normal_edge", "cluster_edge")
+# background class logit of the pixels skipped in the sparse window mode, all other classes get 0
+SPARSE_BACKGROUND_LOGIT = 10.
+
+
+def relative_position_bias(attn):
+    """
+    Args:
+        attn: window attention module holding relative_position_bias_table and relative_position_index
+    Returns:
+        relative_position_bias: (nH, Wh*Ww, Wh*Ww)
+    """
+    if getattr(attn, "frozen_bias", None) is not None:
+        return attn.frozen_bias
+    N = attn.window_size[0] * attn.window_size[1]
+    bias = attn.relative_position_bias_table[attn.relative_position_index.view(-1)].view(N, N, -1)  # Wh*Ww,Wh*Ww,nH
+    return bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+
+
+def window_attention(attn, q, k, v, mask=None):
+    """
+    Attention core shared by WindowAttention, WindowAttention_up and SharedWindowAttention.
+    Args:
+        attn: window attention module (scale, relative position bias, softmax, attn_drop, attn_backend)
+        q, k, v: (num_windows*B, nH, N, head_dim), q not yet scaled
+        mask: (0/-inf) mask with shape of (num_windows, N, N), the frozen bias + mask of shape
+            (num_windows, nH, N, N) or None
+    Returns:
+        x: (num_windows*B, nH, N, head_dim)
+    """
+    B_, nH, N, _ = q.shape
+    # a 4-D mask already carries the relative position bias (see freeze_window_attention)
+    combined = mask is not None and mask.dim() == 4
+    bias = None if combined else relative_position_bias(attn)
+
+    if attn.attn_backend == "sdpa":
+        # relative position bias and shift mask folded into a single additive mask
+        dropout_p = attn.attn_drop.p if attn.training else 0.
+        if mask is None:
+            return F.scaled_dot_product_attention(q, k, v, attn_mask=bias.unsqueeze(0).to(q.dtype),
+                                                  dropout_p=dropout_p, scale=attn.scale)
+        nW = mask.shape[0]
+        attn_mask = mask if combined else bias.unsqueeze(0) + mask.unsqueeze(1)  # nW, nH, N, N
+        # the fused kernels only take 4-D inputs, so the mask is tiled over the batch rather than the windows
+        attn_mask = attn_mask.to(q.dtype).repeat(B_ // nW, 1, 1, 1)  # B_, nH, N, N
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p, scale=attn.scale)
+
+    if attn.scale != 1.:
+        q = q * attn.scale
+    scores = (q @ k.transpose(-2, -1))
+
+    # the LRU cached masks of dynamic_shape stay float32 whatever the model dtype
+    if combined:
+        nW = mask.shape[0]
+        scores = scores.view(B_ // nW, nW, nH, N, N) + mask.to(scores.dtype).unsqueeze(0)
+        scores = scores.view(-1, nH, N, N)
+    else:
+        scores = scores + bias.unsqueeze(0)
+        if mask is not None:
+            nW = mask.shape[0]
+            scores = scores.view(B_ // nW, nW, nH, N, N) + mask.to(scores.dtype).unsqueeze(1).unsqueeze(0)
+            scores = scores.view(-1, nH, N, N)
+    scores = attn.softmax(scores)
+    scores = attn.attn_drop(scores)
+    return scores @ v
+
+
+def freeze_window_attention(block):
+    """
+    Precompute the (nH, N, N) relative position bias of block.attn and, for shifted blocks, the bias plus
+    cyclic-shift mask so that inference skips the gather / permute / copy on every call.
+    The cache is only valid until the weights change, see unfreeze_window_attention.
+    """
+    unfreeze_window_attention(block)
+    with torch.no_grad():
+        bias = relative_position_bias(block.attn).detach().clone()
+        block.attn.register_buffer("frozen_bias", bias, persistent=False)
+        frozen_attn_mask = None
+        if block.attn_mask is not None:
+            frozen_attn_mask = bias.unsqueeze(0) + block.attn_mask.unsqueeze(1)  # nW, nH, N, N
+        block.register_buffer("frozen_attn_mask", frozen_attn_mask, persistent=False)
+
+
+def unfreeze_window_attention(block):
+    if getattr(block.attn, "frozen_bias", None) is not None:
+        block.attn.frozen_bias = None
+    if getattr(block, "frozen_attn_mask", None) is not None:
+        block.frozen_attn_mask = None
+
+
+def sparse_block_forward(block, x, H, W, active):
+    """
+    Sparse window mode of SwinTransformerBlock / SwinTransformerBlock_up: attention and MLP only run on the
+    windows (of this block's partition, so shifted blocks pick their own) holding at least one active token, the
+    tokens of all other windows pass through the block unchanged.
+    Args:
+        x: B, H*W, C
+        active: B, H*W bool map of the foreground tokens
+    """
+    B, L, C = x.shape
+    N = block.window_size * block.window_size
+    index, _ = block_window_index(block, H, W, x.device)
+    windows = active.index_select(1, index).view(-1, N).any(-1).nonzero().squeeze(1)  # active windows of B*nW
+    if windows.numel() == 0:
+        return x
+    nW = L // N
+    # token ids of the active windows in B*H*W, in window order
+    tokens = (index.view(nW, N)[windows % nW] + (windows // nW * L).unsqueeze(1)).view(-1)
+    x = x.reshape(B * L, C)
+    shortcut = x.index_select(0, tokens)
+
+    mask = window_attn_mask(block, H, W, x.device)
+    if mask is not None:
+        mask = mask[windows % nW]  # one window per "image", see window_attention
+    attn_windows = block.attn(block.norm1(shortcut).view(-1, N, C), mask=mask)
+
+    y = shortcut + block.drop_path(attn_windows.view(-1, C))
+    y = y + block.drop_path(block.mlp(block.norm2(y)))
+    return x.index_copy(0, tokens, y).view(B, L, C)
+
+
+def drop_path_residual(x, branch, drop_path):
+    """
+    x + drop_path(branch(x)) with the residual branch only computed for the samples the stochastic depth keeps: the
+    dropped samples skip the branch (forward and backward) instead of having its output multiplied by zero. Kept
+    samples are scaled by 1 / keep_prob as in timm's DropPath, so the expectation and the gradients are the same.
+    The keep mask is drawn on the host, choosing the subset needs no device sync.
+    Args:
+        x: B, ... input, the branch has to treat the samples independently
+        branch: callable applied to the kept samples
+        drop_path: the block's DropPath (or nn.Identity when it has none)
+    """
+    drop_prob = getattr(drop_path, "drop_prob", 0.)
+    if drop_prob == 0.:
+        return x + branch(x)
+    keep_prob = 1. - drop_prob
+    kept = (torch.rand(x.shape[0]) < keep_prob).nonzero().squeeze(1)
+    if kept.numel() == 0:
+        return x
+    if kept.numel() == x.shape[0]:
+        return x + branch(x) / keep_prob
+    kept = kept.to(x.device, non_blocking=True)
+    return x.index_add(0, kept, branch(x.index_select(0, kept)), alpha=1. / keep_prob)
+
+
+def foreground_tokens(x, patch_size, threshold, dilation):
+    """
+    Cheap foreground score of the patch tokens for the sparse window mode: a patch is foreground if it has
+    contrast or differs from the background level (the per image, per channel median of the patch means).
+    Args:
+        x: B, C, H, W images in [0, 1]
+        patch_size (int): patch size of the patch embedding
+        threshold (float): minimum contrast / distance from the background of a foreground patch
+        dilation (int): foreground tokens are dilated by this many tokens to cover context and whole windows
+    Returns:
+        active: B, H/patch_size, W/patch_size bool
+    """
+    patch_max = F.max_pool2d(x, patch_size)
+    contrast = patch_max + F.max_pool2d(-x, patch_size)
+    patch_mean = F.avg_pool2d(x, patch_size)
+    background = patch_mean.flatten(2).median(-1).values[..., None, None]
+    score = torch.maximum(contrast, (patch_mean - background).abs()).amax(1, keepdim=True)
+    active = (score > threshold).float()
+    if dilation > 0:
+        active = F.max_pool2d(active, 2 * dilation + 1, stride=1, padding=dilation)
+    return active[:, 0] > 0
+
+
+def sparse_final_expand(up, output, x, H, W, active, background):
+    """
+    FinalPatchExpand_X4 + 1x1 output convolution on the active tokens only, every other pixel gets the fixed
+    background logits.
+    Args:
+        x: B, H*W, C
+        active: B, H*W bool
+        background: num_classes background logits
+    Returns:
+        logits: B, num_classes, scale*H, scale*W
+    """
+    B, L, C = x.shape
+    scale = up.dim_scale
+    tokens = active.reshape(-1).nonzero().squeeze(1)
+    logits = background.to(x.dtype).expand(B * L, scale * scale, -1).clone()  # B*H*W, scale*scale, num_classes
+    if tokens.numel() > 0:
+        y = up.expand(x.reshape(B * L, C).index_select(0, tokens)).view(-1, scale * scale, up.output_dim)
+        y = F.linear(up.norm(y), output.weight.flatten(1), output.bias)
+        logits = logits.index_copy(0, tokens, y)
+    logits = logits.view(B, H, W, scale, scale, -1)
+    return logits.permute(0, 5, 1, 3, 2, 4).reshape(B, -1, H * scale, W * scale)
+
+
 class WindowAttention_up(nn.Module):
     r""" Window based multi-head self attention (W-MSA) module with relative position bias.
     It supports both of shifted and non-shifted window.
@@ -225,9 +618,12 @@ class WindowAttention_up(nn.Module):
         qk_scale (float | None, optional): Override default qk scale of head_dim ** -0.5 if set
         attn_drop (float, optional): Dropout ratio of attention weight. Default: 0.0
         proj_drop (float, optional): Dropout ratio of output. Default: 0.0
+        attn_backend (str): "math" for the explicit softmax(q @ k^T + bias) @ v reference or "sdpa" for
+            torch.nn.functional.scaled_dot_product_attention. Default: "math"
     """
 
-    def __init__(self, dim, window_size, num_heads, qkv, qk_scale=None, attn_drop=0., proj_drop=0.):
+    def __init__(self, dim, window_size, num_heads, qkv, qk_scale=None, attn_drop=0., proj_drop=0.,
+                 attn_backend="math"):
 
         super().__init__()
         self.dim = dim
@@ -241,23 +637,17 @@ class WindowAttention_up(nn.Module):
             torch.zeros((2 * window_size[0] - 1) * (2 * window_size[1] - 1), num_heads))  # 2*Wh-1 * 2*Ww-1, nH
 
         # get pair-wise relative position index for each token inside the window
-        coords_h = torch.arange(self.window_size[0])
-        coords_w = torch.arange(self.window_size[1])
-        coords = torch.stack(torch.meshgrid([coords_h, coords_w]))  # 2, Wh, Ww
-        coords_flatten = torch.flatten(coords, 1)  # 2, Wh*Ww
-        relative_coords = coords_flatten[:, :, None] - coords_flatten[:, None, :]  # 2, Wh*Ww, Wh*Ww
-        relative_coords = relative_coords.permute(1, 2, 0).contiguous()  # Wh*Ww, Wh*Ww, 2
-        relative_coords[:, :, 0] += self.window_size[0] - 1  # shift to start from 0
-        relative_coords[:, :, 1] += self.window_size[1] - 1
-        relative_coords[:, :, 0] *= 2 * self.window_size[1] - 1
-        relative_position_index = relative_coords.sum(-1)  # Wh*Ww, Wh*Ww
-        self.register_buffer("relative_position_index", relative_position_index)
+        register_shared_buffer(self, "relative_position_index", ("relative_position_index",) + tuple(self.window_size),
+                               compute_relative_position_index(self.window_size))
 
         self.qkv = qkv
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
+        assert attn_backend in ATTN_BACKENDS, f"attn_backend must be one of {ATTN_BACKENDS}"
+        self.attn_backend = attn_backend
+
         trunc_normal_(self.relative_position_bias_table, std=.02)
         self.softmax = nn.Softmax(dim=-1)
 
@@ -273,25 +663,7 @@ class WindowAttention_up(nn.Module):
         qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
 
-        q = q * self.scale
-        attn = (q @ k.transpose(-2, -1))
-
-        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
-        attn = attn + relative_position_bias.unsqueeze(0)
-
-        if mask is not None:
-            nW = mask.shape[0]
-            attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)
-            attn = attn.view(-1, self.num_heads, N, N)
-            attn = self.softmax(attn)
-        else:
-            attn = self.softmax(attn)
-
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B_, N, C)
+        x = window_attention(self, q, k, v, mask).transpose(1, 2).reshape(B_, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -323,9 +695,12 @@ class WindowAttention(nn.Module):
         qk_scale (float | None, optional): Override default qk scale of head_dim ** -0.5 if set
         attn_drop (float, optional): Dropout ratio of attention weight. Default: 0.0
         proj_drop (float, optional): Dropout ratio of output. Default: 0.0
+        attn_backend (str): "math" for the explicit softmax(q @ k^T + bias) @ v reference or "sdpa" for
+            torch.nn.functional.scaled_dot_product_attention. Default: "math"
     """
 
-    def __init__(self, dim, window_size, num_heads, qkv_bias=True, qk_scale=None, attn_drop=0., proj_drop=0.):
+    def __init__(self, dim, window_size, num_heads, qkv_bias=True, qk_scale=None, attn_drop=0., proj_drop=0.,
+                 attn_backend="math"):
 
         super().__init__()
         self.dim = dim
@@ -339,23 +714,17 @@ class WindowAttention(nn.Module):
             torch.zeros((2 * window_size[0] - 1) * (2 * window_size[1] - 1), num_heads))  # 2*Wh-1 * 2*Ww-1, nH
 
         # get pair-wise relative position index for each token inside the window
-        coords_h = torch.arange(self.window_size[0])
-        coords_w = torch.arange(self.window_size[1])
-        coords = torch.stack(torch.meshgrid([coords_h, coords_w]))  # 2, Wh, Ww
-        coords_flatten = torch.flatten(coords, 1)  # 2, Wh*Ww
-        relative_coords = coords_flatten[:, :, None] - coords_flatten[:, None, :]  # 2, Wh*Ww, Wh*Ww
-        relative_coords = relative_coords.permute(1, 2, 0).contiguous()  # Wh*Ww, Wh*Ww, 2
-        relative_coords[:, :, 0] += self.window_size[0] - 1  # shift to start from 0
-        relative_coords[:, :, 1] += self.window_size[1] - 1
-        relative_coords[:, :, 0] *= 2 * self.window_size[1] - 1
-        relative_position_index = relative_coords.sum(-1)  # Wh*Ww, Wh*Ww
-        self.register_buffer("relative_position_index", relative_position_index)
+        register_shared_buffer(self, "relative_position_index", ("relative_position_index",) + tuple(self.window_size),
+                               compute_relative_position_index(self.window_size))
 
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
+        assert attn_backend in ATTN_BACKENDS, f"attn_backend must be one of {ATTN_BACKENDS}"
+        self.attn_backend = attn_backend
+
         trunc_normal_(self.relative_position_bias_table, std=.02)
         self.softmax = nn.Softmax(dim=-1)
 
@@ -369,25 +738,7 @@ class WindowAttention(nn.Module):
         qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
 
-        q = q * self.scale
-        attn = (q @ k.transpose(-2, -1))
-
-        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
-        attn = attn + relative_position_bias.unsqueeze(0)
-
-        if mask is not None:
-            nW = mask.shape[0]
-            attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)
-            attn = attn.view(-1, self.num_heads, N, N)
-            attn = self.softmax(attn)
-        else:
-            attn = self.softmax(attn)
-
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B_, N, C)
+        x = window_attention(self, q, k, v, mask).transpose(1, 2).reshape(B_, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -422,9 +773,13 @@ class SharedWindowAttention(nn.Module):
         qk_scale (float | None, optional): Override default qk scale of head_dim ** -0.5 if set
         attn_drop (float, optional): Dropout ratio of attention weight. Default: 0.0
         proj_drop (float, optional): Dropout ratio of output. Default: 0.0
+        shared_ratio (float): Ratio of windows projected by the shared qkv. Default: 0.5
+        attn_backend (str): "math" for the explicit softmax(q @ k^T + bias) @ v reference or "sdpa" for
+            torch.nn.functional.scaled_dot_product_attention. Default: "math"
     """
 
-    def __init__(self, dim, window_size, num_heads, qkv,shared_qkv ,qk_scale=None, attn_drop=0., proj_drop=0.,shared_ratio = 0.5):
+    def __init__(self, dim, window_size, num_heads, qkv,shared_qkv ,qk_scale=None, attn_drop=0., proj_drop=0.,shared_ratio = 0.5,
+                 attn_backend="math"):
 
         super().__init__()
         self.dim = dim
@@ -438,17 +793,8 @@ class SharedWindowAttention(nn.Module):
             torch.zeros((2 * window_size[0] - 1) * (2 * window_size[1] - 1), num_heads))  # 2*Wh-1 * 2*Ww-1, nH
 
         # get pair-wise relative position index for each token inside the window
-        coords_h = torch.arange(self.window_size[0])
-        coords_w = torch.arange(self.window_size[1])
-        coords = torch.stack(torch.meshgrid([coords_h, coords_w]))  # 2, Wh, Ww
-        coords_flatten = torch.flatten(coords, 1)  # 2, Wh*Ww
-        relative_coords = coords_flatten[:, :, None] - coords_flatten[:, None, :]  # 2, Wh*Ww, Wh*Ww
-        relative_coords = relative_coords.permute(1, 2, 0).contiguous()  # Wh*Ww, Wh*Ww, 2
-        relative_coords[:, :, 0] += self.window_size[0] - 1  # shift to start from 0
-        relative_coords[:, :, 1] += self.window_size[1] - 1
-        relative_coords[:, :, 0] *= 2 * self.window_size[1] - 1
-        relative_position_index = relative_coords.sum(-1)  # Wh*Ww, Wh*Ww
-        self.register_buffer("relative_position_index", relative_position_index)
+        register_shared_buffer(self, "relative_position_index", ("relative_position_index",) + tuple(self.window_size),
+                               compute_relative_position_index(self.window_size))
 
         self.qkv = qkv
         self.shared_qkv = shared_qkv
@@ -456,10 +802,29 @@ class SharedWindowAttention(nn.Module):
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
         self.shared_ratio = shared_ratio
+        # leading windows projected by shared_qkv, int(N*shared_ratio) with N the tokens per window
+        self.shared_size = int(window_size[0] * window_size[1] * shared_ratio)
+
+        assert attn_backend in ATTN_BACKENDS, f"attn_backend must be one of {ATTN_BACKENDS}"
+        self.attn_backend = attn_backend
 
         trunc_normal_(self.relative_position_bias_table, std=.02)
         self.softmax = nn.Softmax(dim=-1)
 
+    def project_qkv(self, x, shared_size):
+        """
+        The first shared_size windows take q, k, v from shared_qkv and the rest from qkv, so each
+        projection only runs on the rows it contributes. The split is a plain slice with a constant bound and no
+        branch on num_windows*B, so a traced or exported graph stays right for any batch size (a slice past the
+        end is simply empty).
+        Args:
+            x: input features with shape of (num_windows*B, N, C)
+            shared_size (int): number of leading windows projected by shared_qkv
+        Returns:
+            qkv: (num_windows*B, N, 3*C)
+        """
+        return torch.cat((self.shared_qkv(x[:shared_size]), self.qkv(x[shared_size:])), 0)
+
     def forward(self, x, mask=None):
         """
         Args:
@@ -467,35 +832,10 @@ class SharedWindowAttention(nn.Module):
             mask: (0/-inf) mask with shape of (num_windows, Wh*Ww, Wh*Ww) or None
         """
         B_, N, C = x.shape
-        shared_size = int(N*self.shared_ratio)
-        qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
-        #print("qkv shape ",qkv.shape)
-        shared_qkv = self.shared_qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+        qkv = self.project_qkv(x, self.shared_size).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
-        shared_q,shared_k,shared_v = shared_qkv[0], shared_qkv[1], shared_qkv[2]
-
-        q = torch.concat((shared_q[:shared_size],q[shared_size:]),0)
-        k = torch.concat((shared_k[:shared_size],k[shared_size:]),0)
-        v = torch.concat((shared_v[:shared_size],v[shared_size:]),0)
-        q = q * self.scale
-        attn = (q @ k.transpose(-2, -1))
-
-        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
-        attn = attn + relative_position_bias.unsqueeze(0)
-
-        if mask is not None:
-            nW = mask.shape[0]
-            attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)
-            attn = attn.view(-1, self.num_heads, N, N)
-            attn = self.softmax(attn)
-        else:
-            attn = self.softmax(attn)
 
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B_, N, C)
+        x = window_attention(self, q, k, v, mask).transpose(1, 2).reshape(B_, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -556,73 +896,60 @@ class SwinTransformerBlock(nn.Module):
             qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
 
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
+        self.skip_dropped_paths = False
         self.norm2 = norm_layer(dim)
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
 
-        if self.shift_size > 0:
-            # calculate attention mask for SW-MSA
-            H, W = self.input_resolution
-            img_mask = torch.zeros((1, H, W, 1))  # 1 H W 1
-            h_slices = (slice(0, -self.window_size),
-                        slice(-self.window_size, -self.shift_size),
-                        slice(-self.shift_size, None))
-            w_slices = (slice(0, -self.window_size),
-                        slice(-self.window_size, -self.shift_size),
-                        slice(-self.shift_size, None))
-            cnt = 0
-            for h in h_slices:
-                for w in w_slices:
-                    img_mask[:, h, w, :] = cnt
-                    cnt += 1
-
-            mask_windows = window_partition(img_mask, self.window_size)  # nW, window_size, window_size, 1
-            mask_windows = mask_windows.view(-1, self.window_size * self.window_size)
-            attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
-            attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
-        else:
-            attn_mask = None
-
-        self.register_buffer("attn_mask", attn_mask)
-
-    def forward(self, x):
+        # calculate attention mask for SW-MSA
         H, W = self.input_resolution
+        geometry = (H, W, self.window_size, self.shift_size)
+        attn_mask = compute_attn_mask(*geometry)
+        register_shared_buffer(self, "attn_mask", ("attn_mask",) + geometry, attn_mask)
+        index, index_inv = compute_window_index(*geometry)
+        register_shared_buffer(self, "window_index", ("window_index",) + geometry, index)
+        register_shared_buffer(self, "window_index_inv", ("window_index_inv",) + geometry, index_inv)
+
+    def forward(self, x, H=None, W=None, active=None):
+        """
+        active: optional B, H*W bool map of the foreground tokens (sparse window mode), only the windows
+            holding one are processed, see sparse_block_forward
+        """
+        if H is None:
+            H, W = self.input_resolution
         B, L, C = x.shape
-        assert L == H * W, "input feature has wrong size"
+        torch._assert(L == H * W, "input feature has wrong size")
+        if active is not None:
+            return sparse_block_forward(self, x, H, W, active)
 
-        shortcut = x
-        x = self.norm1(x)
-        x = x.view(B, H, W, C)
+        if self.skip_dropped_paths and self.training:
+            x = drop_path_residual(x, functools.partial(self.attn_branch, H=H, W=W), self.drop_path)
+            return drop_path_residual(x, self.mlp_branch, self.drop_path)
 
-        # cyclic shift
-        if self.shift_size > 0:
-            shifted_x = torch.roll(x, shifts=(-self.shift_size, -self.shift_size), dims=(1, 2))
-        else:
-            shifted_x = x
+        x = x + self.drop_path(self.attn_branch(x, H, W))
 
-        # partition windows
-        x_windows = window_partition(shifted_x, self.window_size)  # nW*B, window_size, window_size, C
-        x_windows = x_windows.view(-1, self.window_size * self.window_size, C)  # nW*B, window_size*window_size, C
+        # FFN
+        x = x + self.drop_path(self.mlp_branch(x))
 
-        # W-MSA/SW-MSA
-        attn_windows = self.attn(x_windows, mask=self.attn_mask)  # nW*B, window_size*window_size, C
+        return x
 
-        # merge windows
-        attn_windows = attn_windows.view(-1, self.window_size, self.window_size, C)
-        shifted_x = window_reverse(attn_windows, self.window_size, H, W)  # B H' W' C
+    def attn_branch(self, x, H, W):
+        B, L, C = x.shape
+        x = self.norm1(x)
 
-        # reverse cyclic shift
-        if self.shift_size > 0:
-            x = torch.roll(shifted_x, shifts=(self.shift_size, self.shift_size), dims=(1, 2))
-        else:
-            x = shifted_x
-        x = x.view(B, H * W, C)
+        # cyclic shift and window partition in one gather
+        index, index_inv = block_window_index(self, H, W, x.device)
+        x_windows = x.index_select(1, index).view(-1, self.window_size * self.window_size, C)  # nW*B, window_size*window_size, C
 
-        # FFN
-        x = shortcut + self.drop_path(x)
-        x = x + self.drop_path(self.mlp(self.norm2(x)))
+        # W-MSA/SW-MSA
+        mask = window_attn_mask(self, H, W, x.device)
+        attn_windows = self.attn(x_windows, mask=mask)  # nW*B, window_size*window_size, C
 
-        return x
+        # merge windows and reverse cyclic shift in one gather
+        return attn_windows.view(B, H * W, C).index_select(1, index_inv)
+
+    def mlp_branch(self, x):
+        return self.mlp(self.norm2(x))
 
     def extra_repr(self) -> str:
         return f"dim={self.dim}, input_resolution={self.input_resolution}, num_heads={self.num_heads}, " \
@@ -684,73 +1011,60 @@ class SwinTransformerBlock_up(nn.Module):
             qkv=qkv, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
 
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
+        self.skip_dropped_paths = False
         self.norm2 = norm_layer(dim)
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
 
-        if self.shift_size > 0:
-            # calculate attention mask for SW-MSA
-            H, W = self.input_resolution
-            img_mask = torch.zeros((1, H, W, 1))  # 1 H W 1
-            h_slices = (slice(0, -self.window_size),
-                        slice(-self.window_size, -self.shift_size),
-                        slice(-self.shift_size, None))
-            w_slices = (slice(0, -self.window_size),
-                        slice(-self.window_size, -self.shift_size),
-                        slice(-self.shift_size, None))
-            cnt = 0
-            for h in h_slices:
-                for w in w_slices:
-                    img_mask[:, h, w, :] = cnt
-                    cnt += 1
-
-            mask_windows = window_partition(img_mask, self.window_size)  # nW, window_size, window_size, 1
-            mask_windows = mask_windows.view(-1, self.window_size * self.window_size)
-            attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
-            attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
-        else:
-            attn_mask = None
-
-        self.register_buffer("attn_mask", attn_mask)
-
-    def forward(self, x):
+        # calculate attention mask for SW-MSA
         H, W = self.input_resolution
+        geometry = (H, W, self.window_size, self.shift_size)
+        attn_mask = compute_attn_mask(*geometry)
+        register_shared_buffer(self, "attn_mask", ("attn_mask",) + geometry, attn_mask)
+        index, index_inv = compute_window_index(*geometry)
+        register_shared_buffer(self, "window_index", ("window_index",) + geometry, index)
+        register_shared_buffer(self, "window_index_inv", ("window_index_inv",) + geometry, index_inv)
+
+    def forward(self, x, H=None, W=None, active=None):
+        """
+        active: optional B, H*W bool map of the foreground tokens (sparse window mode), only the windows
+            holding one are processed, see sparse_block_forward
+        """
+        if H is None:
+            H, W = self.input_resolution
         B, L, C = x.shape
-        assert L == H * W, "input feature has wrong size"
+        torch._assert(L == H * W, "input feature has wrong size")
+        if active is not None:
+            return sparse_block_forward(self, x, H, W, active)
 
-        shortcut = x
-        x = self.norm1(x)
-        x = x.view(B, H, W, C)
+        if self.skip_dropped_paths and self.training:
+            x = drop_path_residual(x, functools.partial(self.attn_branch, H=H, W=W), self.drop_path)
+            return drop_path_residual(x, self.mlp_branch, self.drop_path)
 
-        # cyclic shift
-        if self.shift_size > 0:
-            shifted_x = torch.roll(x, shifts=(-self.shift_size, -self.shift_size), dims=(1, 2))
-        else:
-            shifted_x = x
+        x = x + self.drop_path(self.attn_branch(x, H, W))
 
-        # partition windows
-        x_windows = window_partition(shifted_x, self.window_size)  # nW*B, window_size, window_size, C
-        x_windows = x_windows.view(-1, self.window_size * self.window_size, C)  # nW*B, window_size*window_size, C
+        # FFN
+        x = x + self.drop_path(self.mlp_branch(x))
 
-        # W-MSA/SW-MSA
-        attn_windows = self.attn(x_windows, mask=self.attn_mask)  # nW*B, window_size*window_size, C
+        return x
+
+    def attn_branch(self, x, H, W):
+        B, L, C = x.shape
+        x = self.norm1(x)
 
-        # merge windows
-        attn_windows = attn_windows.view(-1, self.window_size, self.window_size, C)
-        shifted_x = window_reverse(attn_windows, self.window_size, H, W)  # B H' W' C
+        # cyclic shift and window partition in one gather
+        index, index_inv = block_window_index(self, H, W, x.device)
+        x_windows = x.index_select(1, index).view(-1, self.window_size * self.window_size, C)  # nW*B, window_size*window_size, C
 
-        # reverse cyclic shift
-        if self.shift_size > 0:
-            x = torch.roll(shifted_x, shifts=(self.shift_size, self.shift_size), dims=(1, 2))
-        else:
-            x = shifted_x
-        x = x.view(B, H * W, C)
+        # W-MSA/SW-MSA
+        mask = window_attn_mask(self, H, W, x.device)
+        attn_windows = self.attn(x_windows, mask=mask)  # nW*B, window_size*window_size, C
 
-        # FFN
-        x = shortcut + self.drop_path(x)
-        x = x + self.drop_path(self.mlp(self.norm2(x)))
+        # merge windows and reverse cyclic shift in one gather
+        return attn_windows.view(B, H * W, C).index_select(1, index_inv)
 
-        return x
+    def mlp_branch(self, x):
+        return self.mlp(self.norm2(x))
 
     def extra_repr(self) -> str:
         return f"dim={self.dim}, input_resolution={self.input_resolution}, num_heads={self.num_heads}, " \
@@ -814,69 +1128,47 @@ class Shared_SwinTransformerBlock(nn.Module):
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
 
-        if self.shift_size > 0:
-            # calculate attention mask for SW-MSA
-            H, W = self.input_resolution
-            img_mask = torch.zeros((1, H, W, 1))  # 1 H W 1
-            h_slices = (slice(0, -self.window_size),
-                        slice(-self.window_size, -self.shift_size),
-                        slice(-self.shift_size, None))
-            w_slices = (slice(0, -self.window_size),
-                        slice(-self.window_size, -self.shift_size),
-                        slice(-self.shift_size, None))
-            cnt = 0
-            for h in h_slices:
-                for w in w_slices:
-                    img_mask[:, h, w, :] = cnt
-                    cnt += 1
-
-            mask_windows = window_partition(img_mask, self.window_size)  # nW, window_size, window_size, 1
-            mask_windows = mask_windows.view(-1, self.window_size * self.window_size)
-            attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
-            attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
-        else:
-            attn_mask = None
-
-        self.register_buffer("attn_mask", attn_mask)
-
-    def forward(self, x):
+        # calculate attention mask for SW-MSA
         H, W = self.input_resolution
+        geometry = (H, W, self.window_size, self.shift_size)
+        attn_mask = compute_attn_mask(*geometry)
+        register_shared_buffer(self, "attn_mask", ("attn_mask",) + geometry, attn_mask)
+        index, index_inv = compute_window_index(*geometry)
+        register_shared_buffer(self, "window_index", ("window_index",) + geometry, index)
+        register_shared_buffer(self, "window_index_inv", ("window_index_inv",) + geometry, index_inv)
+
+    def forward(self, x, H=None, W=None):
+        if H is None:
+            H, W = self.input_resolution
         B, L, C = x.shape
-        assert L == H * W, "input feature has wrong size"
+        torch._assert(L == H * W, "input feature has wrong size")
 
-        shortcut = x
-        x = self.norm1(x)
-        x = x.view(B, H, W, C)
+        # no drop_path_residual here: SharedWindowAttention splits shared / private windows by their position in
+        # the batch, so running the branch on the kept samples only would change their projection
+        x = x + self.drop_path(self.attn_branch(x, H, W))
 
-        # cyclic shift
-        if self.shift_size > 0:
-            shifted_x = torch.roll(x, shifts=(-self.shift_size, -self.shift_size), dims=(1, 2))
-        else:
-            shifted_x = x
+        # FFN
+        x = x + self.drop_path(self.mlp_branch(x))
 
-        # partition windows
-        x_windows = window_partition(shifted_x, self.window_size)  # nW*B, window_size, window_size, C
-        x_windows = x_windows.view(-1, self.window_size * self.window_size, C)  # nW*B, window_size*window_size, C
+        return x
 
-        # W-MSA/SW-MSA
-        attn_windows = self.attn(x_windows, mask=self.attn_mask)  # nW*B, window_size*window_size, C
+    def attn_branch(self, x, H, W):
+        B, L, C = x.shape
+        x = self.norm1(x)
 
-        # merge windows
-        attn_windows = attn_windows.view(-1, self.window_size, self.window_size, C)
-        shifted_x = window_reverse(attn_windows, self.window_size, H, W)  # B H' W' C
+        # cyclic shift and window partition in one gather
+        index, index_inv = block_window_index(self, H, W, x.device)
+        x_windows = x.index_select(1, index).view(-1, self.window_size * self.window_size, C)  # nW*B, window_size*window_size, C
 
-        # reverse cyclic shift
-        if self.shift_size > 0:
-            x = torch.roll(shifted_x, shifts=(self.shift_size, self.shift_size), dims=(1, 2))
-        else:
-            x = shifted_x
-        x = x.view(B, H * W, C)
+        # W-MSA/SW-MSA
+        mask = window_attn_mask(self, H, W, x.device)
+        attn_windows = self.attn(x_windows, mask=mask)  # nW*B, window_size*window_size, C
 
-        # FFN
-        x = shortcut + self.drop_path(x)
-        x = x + self.drop_path(self.mlp(self.norm2(x)))
+        # merge windows and reverse cyclic shift in one gather
+        return attn_windows.view(B, H * W, C).index_select(1, index_inv)
 
-        return x
+    def mlp_branch(self, x):
+        return self.mlp(self.norm2(x))
 
     def extra_repr(self) -> str:
         return f"dim={self.dim}, input_resolution={self.input_resolution}, num_heads={self.num_heads}, " \
@@ -913,14 +1205,15 @@ class PatchMerging(nn.Module):
         self.reduction = nn.Linear(4 * dim, 2 * dim, bias=False)
         self.norm = norm_layer(4 * dim)
 
-    def forward(self, x):
+    def forward(self, x, H=None, W=None):
         """
         x: B, H*W, C
         """
-        H, W = self.input_resolution
+        if H is None:
+            H, W = self.input_resolution
         B, L, C = x.shape
-        assert L == H * W, "input feature has wrong size"
-        assert H % 2 == 0 and W % 2 == 0, f"x size ({H}*{W}) are not even."
+        torch._assert(L == H * W, "input feature has wrong size")
+        torch._assert(H % 2 == 0 and W % 2 == 0, f"x size ({H}*{W}) are not even.")
 
         x = x.view(B, H, W, C)
 
@@ -945,6 +1238,18 @@ class PatchMerging(nn.Module):
         flops += (H // 2) * (W // 2) * 4 * self.dim * 2 * self.dim
         return flops
 
+def pixel_shuffle_tokens(x, B, H, W, scale):
+    """
+    rearrange(x, 'b (h w) (p1 p2 c) -> b (h p1) (w p2) c') with view / permute only, which export to plain
+    Reshape / Transpose.
+    Args:
+        x: B, H*W, scale*scale*C
+    Returns:
+        x: B, H*scale, W*scale, C
+    """
+    x = x.view(B, H, W, scale, scale, -1)
+    return x.permute(0, 1, 3, 2, 4, 5).reshape(B, H * scale, W * scale, -1)
+
 class PatchExpand(nn.Module):
     def __init__(self, input_resolution, dim, dim_scale=2, norm_layer=nn.LayerNorm):
         super().__init__()
@@ -953,17 +1258,17 @@ class PatchExpand(nn.Module):
         self.expand = nn.Linear(dim, 2*dim, bias=False) if dim_scale==2 else nn.Identity()
         self.norm = norm_layer(dim // dim_scale)
 
-    def forward(self, x):
+    def forward(self, x, H=None, W=None):
         """
         x: B, H*W, C
         """
-        H, W = self.input_resolution
+        if H is None:
+            H, W = self.input_resolution
         x = self.expand(x)
         B, L, C = x.shape
-        assert L == H * W, "input feature has wrong size"
+        torch._assert(L == H * W, "input feature has wrong size")
 
-        x = x.view(B, H, W, C)
-        x = rearrange(x, 'b h w (p1 p2 c)-> b (h p1) (w p2) c', p1=2, p2=2, c=C//4)
+        x = pixel_shuffle_tokens(x, B, H, W, 2)
         x = x.view(B,-1,C//4)
         x= self.norm(x)
 
@@ -979,17 +1284,17 @@ class FinalPatchExpand_X4(nn.Module):
         self.output_dim = dim 
         self.norm = norm_layer(self.output_dim)
 
-    def forward(self, x):
+    def forward(self, x, H=None, W=None):
         """
         x: B, H*W, C
         """
-        H, W = self.input_resolution
+        if H is None:
+            H, W = self.input_resolution
         x = self.expand(x)
         B, L, C = x.shape
-        assert L == H * W, "input feature has wrong size"
+        torch._assert(L == H * W, "input feature has wrong size")
 
-        x = x.view(B, H, W, C)
-        x = rearrange(x, 'b h w (p1 p2 c)-> b (h p1) (w p2) c', p1=self.dim_scale, p2=self.dim_scale, c=C//(self.dim_scale**2))
+        x = pixel_shuffle_tokens(x, B, H, W, self.dim_scale)
         x = x.view(B,-1,self.output_dim)
         x= self.norm(x)
 
@@ -1042,14 +1347,18 @@ class BasicLayer(nn.Module):
         else:
             self.downsample = None
 
-    def forward(self, x):
+    def forward(self, x, H=None, W=None, active=None):
+        # active: sparse window mode, dict of (H, W) -> B, H*W foreground token map
+        if H is None:
+            H, W = self.input_resolution
+        active = None if active is None else active.get((H, W))
         for blk in self.blocks:
             if self.use_checkpoint:
-                x = checkpoint.checkpoint(blk, x)
+                x = checkpoint.checkpoint(blk, x, H, W, active)
             else:
-                x = blk(x)
+                x = blk(x, H, W, active)
         if self.downsample is not None:
-            x = self.downsample(x)
+            x = self.downsample(x, H, W)
         return x
 
     def extra_repr(self) -> str:
@@ -1113,14 +1422,18 @@ class BasicLayer_up(nn.Module):
         else:
             self.upsample = None
 
-    def forward(self, x):
+    def forward(self, x, H=None, W=None, active=None):
+        # active: sparse window mode, dict of (H, W) -> B, H*W foreground token map
+        if H is None:
+            H, W = self.input_resolution
+        active = None if active is None else active.get((H, W))
         for blk in self.blocks:
             if self.use_checkpoint:
-                x = checkpoint.checkpoint(blk, x)
+                x = checkpoint.checkpoint(blk, x, H, W, active)
             else:
-                x = blk(x)
+                x = blk(x, H, W, active)
         if self.upsample is not None:
-            x = self.upsample(x)
+            x = self.upsample(x, H, W)
         return x
 
 class Shared_BasicLayer_up(nn.Module):
@@ -1186,14 +1499,16 @@ class Shared_BasicLayer_up(nn.Module):
         else:
             self.upsample = None
 
-    def forward(self, x):
+    def forward(self, x, H=None, W=None):
+        if H is None:
+            H, W = self.input_resolution
         for blk in self.blocks:
             if self.use_checkpoint:
-                x = checkpoint.checkpoint(blk, x)
+                x = checkpoint.checkpoint(blk, x, H, W)
             else:
-                x = blk(x)
+                x = blk(x, H, W)
         if self.upsample is not None:
-            x = self.upsample(x)
+            x = self.upsample(x, H, W)
         return x
 
 class PatchEmbed(nn.Module):
@@ -1204,9 +1519,10 @@ class PatchEmbed(nn.Module):
         in_chans (int): Number of input image channels. Default: 3.
         embed_dim (int): Number of linear projection output channels. Default: 96.
         norm_layer (nn.Module, optional): Normalization layer. Default: None
+        strict_img_size (bool): If True, only accept inputs of exactly img_size. Default: True
     """
 
-    def __init__(self, img_size=224, patch_size=4, in_chans=3, embed_dim=96, norm_layer=None):
+    def __init__(self, img_size=224, patch_size=4, in_chans=3, embed_dim=96, norm_layer=None, strict_img_size=True):
         super().__init__()
         img_size = to_2tuple(img_size)
         patch_size = to_2tuple(patch_size)
@@ -1215,6 +1531,7 @@ class PatchEmbed(nn.Module):
         self.patch_size = patch_size
         self.patches_resolution = patches_resolution
         self.num_patches = patches_resolution[0] * patches_resolution[1]
+        self.strict_img_size = strict_img_size
 
         self.in_chans = in_chans
         self.embed_dim = embed_dim
@@ -1227,9 +1544,11 @@ class PatchEmbed(nn.Module):
 
     def forward(self, x):
         B, C, H, W = x.shape
-        # FIXME look at relaxing size constraints
-        assert H == self.img_size[0] and W == self.img_size[1], \
-            f"Input image size ({H}*{W}) doesn't match model ({self.img_size[0]}*{self.img_size[1]})."
+        if self.strict_img_size:
+            torch._assert(H == self.img_size[0] and W == self.img_size[1],
+                          f"Input image size ({H}*{W}) doesn't match model ({self.img_size[0]}*{self.img_size[1]}).")
+        torch._assert(H % self.patch_size[0] == 0 and W % self.patch_size[1] == 0,
+                      f"Input image size ({H}*{W}) is not a multiple of the patch size {self.patch_size}.")
         x = self.proj(x).flatten(2).transpose(1, 2)  # B Ph*Pw C
         if self.norm is not None:
             x = self.norm(x)
@@ -1242,6 +1561,131 @@ class PatchEmbed(nn.Module):
             flops += Ho * Wo * self.embed_dim
         return flops
 
+def profile_saved_activations(model, stages, example_input):
+    """
+    Bytes of the tensors autograd saves for backward during one training forward pass, per stage (shared modules
+    called twice count twice) plus "other" for everything outside the stages. Parameters are not counted.
+    Returns:
+        saved: dict of stage name -> bytes, inputs: dict of stage name -> bytes of the stage inputs
+    """
+    saved = {name: 0 for name in stages}
+    saved["other"] = 0
+    inputs = {name: 0 for name in stages}
+    parameters = {p.data_ptr() for p in model.parameters()}
+    current = ["other"]
+    seen = set()
+
+    def pack(t):
+        key = (t.data_ptr(), t.shape, t.dtype)
+        if t.data_ptr() not in parameters and key not in seen:
+            seen.add(key)
+            saved[current[-1]] += t.numel() * t.element_size()
+        return t
+
+    handles = []
+    for name, modules in stages.items():
+        for m in modules:
+            def pre_hook(module, args, name=name):
+                current.append(name)
+                inputs[name] += args[0].numel() * args[0].element_size()
+
+            def post_hook(module, args, output):
+                current.pop()
+
+            handles.append(m.register_forward_pre_hook(pre_hook))
+            handles.append(m.register_forward_hook(post_hook))
+
+    training = model.training
+    model.train()
+    try:
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+            model(example_input)
+    finally:
+        for handle in handles:
+            handle.remove()
+        model.train(training)
+    return saved, inputs
+
+
+def select_checkpoint_stages(model, stages, example_input, budget, batch_size=None):
+    """
+    Greedy choice of the stages to checkpoint: the estimated peak training memory is the model state (parameters,
+    gradients and two Adam moments) plus the saved activations, where a checkpointed stage only keeps its input but
+    the largest checkpointed stage is recomputed in full during backward. Stages are checkpointed by decreasing
+    saving until the estimate fits the budget (in bytes), all of them if it never does.
+    """
+    for modules in stages.values():
+        for m in modules:
+            m.use_checkpoint = False
+    saved, inputs = profile_saved_activations(model, stages, example_input)
+    scale = (batch_size or example_input.shape[0]) / example_input.shape[0]
+    state = 4 * sum(p.numel() * p.element_size() for p in model.parameters())
+
+    def estimate(selected):
+        activations = sum(saved[name] for name in saved if name not in selected)
+        activations += sum(inputs[name] for name in selected)
+        activations += max([saved[name] for name in selected], default=0)
+        return state + scale * activations
+
+    selected = []
+    candidates = sorted(stages, key=lambda name: saved[name] - inputs[name], reverse=True)
+    for name in candidates:
+        if estimate(selected) <= budget:
+            break
+        selected.append(name)
+    if estimate(selected) > budget:
+        logging.warning("estimated peak memory {:.0f}MB exceeds the budget of {:.0f}MB even with every stage "
+                        "checkpointed".format(estimate(selected) / 2 ** 20, budget / 2 ** 20))
+    logging.info("checkpointing {}, estimated peak memory {:.0f}MB".format(selected, estimate(selected) / 2 ** 20))
+    return selected
+
+
+class ConcatLinear(nn.Module):
+    r""" Linear layer over torch.cat([x, skip], -1) evaluated as two accumulated GEMMs, without the concat copy.
+    Args:
+        linear (nn.Linear): concat_back_dim linear to split
+        dim (int): Number of channels of x, the remaining input channels belong to skip.
+    """
+
+    def __init__(self, linear, dim):
+        super().__init__()
+        self.weight_x = nn.Parameter(linear.weight[:, :dim].detach().clone())
+        self.weight_skip = nn.Parameter(linear.weight[:, dim:].detach().clone())
+        self.bias = None if linear.bias is None else nn.Parameter(linear.bias.detach().clone())
+
+    def forward(self, x, skip):
+        out = F.linear(x, self.weight_x, self.bias)
+        out.view(-1, out.shape[-1]).addmm_(skip.reshape(-1, skip.shape[-1]), self.weight_skip.t())
+        return out
+
+
+def fold_layernorm(norm, linear, q_scale=None):
+    """
+    Folds the affine part of norm (and optionally the attention scale of the q rows) into the linear layer after it.
+    Args:
+        norm (nn.LayerNorm): normalization in front of linear
+        linear (nn.Linear): qkv or fc1, left untouched since it may be shared with other blocks
+        q_scale (float | None): scale of the q part of a qkv projection, i.e. of the first third of the rows
+    Returns:
+        norm: LayerNorm without affine parameters
+        linear: new Linear with W * gamma and W @ beta + b
+    """
+    weight, bias = linear.weight.detach(), linear.bias
+    bias = torch.zeros_like(weight[:, 0]) if bias is None else bias.detach()
+    if norm.elementwise_affine:
+        if norm.bias is not None:
+            bias = bias + weight @ norm.bias.detach()
+        weight = weight * norm.weight.detach()
+    if q_scale is not None:
+        scale = torch.ones_like(bias)
+        scale[:weight.shape[0] // 3] = q_scale
+        weight, bias = weight * scale[:, None], bias * scale
+    folded = nn.Linear(linear.in_features, linear.out_features, device=weight.device, dtype=weight.dtype)
+    folded.weight.data.copy_(weight)
+    folded.bias.data.copy_(bias)
+    return nn.LayerNorm(norm.normalized_shape, eps=norm.eps, elementwise_affine=False), folded
+
+
 class TransNuSeg(nn.Module):
     r""" 
     Args:
@@ -1264,6 +1708,27 @@ class TransNuSeg(nn.Module):
         patch_norm (bool): If True, add normalization after patch embedding. Default: True
         use_checkpoint (bool): Whether to use checkpointing to save memory. Default: False
         shared_ratio: sharing ratio between decoders, Default: 0.5
+        share_encoder (bool): If True, run the encoder once and feed the same features and skip connections
+            to the nuclei and edge decoders. Default: True
+        independent_dropout (bool): If True, draw separate dropout / DropPath masks for every branch during
+            training, i.e. run the encoder once per branch and the shared edge trunk once per edge decoder.
+            Default: False
+        share_edge_trunk (bool): If True, compute the stages that the normal edge and cluster edge decoders
+            share only once and fork at the first unshared stage. Default: True
+        attn_backend (str): Window attention backend, "math" (reference) or "sdpa"
+            (torch.nn.functional.scaled_dot_product_attention). Default: "math"
+        dynamic_shape (bool): If True, accept any input size: the input is padded to a multiple of pad_multiple,
+            shift masks for new sizes come from an LRU cache and the logits are cropped back. Default: False
+        heads (tuple(str)): Heads computed by forward when none are requested explicitly, a subset of
+            ("nuclei", "normal_edge", "cluster_edge"). Default: all three
+        sparse_threshold (float | None): Inference only. If set, windows without foreground patches (contrast or
+            distance from the background level above the threshold, see foreground_tokens) are skipped by the
+            encoder and nuclei decoder blocks and get fixed background logits. Default: None
+        sparse_dilation (int | None): Number of tokens the foreground is dilated by in the sparse window mode.
+            Default: window_size
+        skip_dropped_paths (bool): Training only. If True, stochastic depth skips the residual branches of the
+            dropped samples instead of computing them and multiplying by zero (except in the shared edge decoder
+            blocks). Default: False
     """
 
     def __init__(self, img_size=512, patch_size=4, in_chans=3, num_classes=2,
@@ -1271,7 +1736,10 @@ class TransNuSeg(nn.Module):
                  window_size=8, mlp_ratio=4., qkv_bias=True, qk_scale=None,
                  drop_rate=0., attn_drop_rate=0., drop_path_rate=0.1,
                  norm_layer=nn.LayerNorm, ape=False, patch_norm=True,
-                 use_checkpoint=False, final_upsample="expand_first", shared_ratio = 0.5,**kwargs):
+                 use_checkpoint=False, final_upsample="expand_first", shared_ratio = 0.5,
+                 share_encoder=True, independent_dropout=False, share_edge_trunk=True,
+                 attn_backend="math", dynamic_shape=False, heads=None,
+                 sparse_threshold=None, sparse_dilation=None, skip_dropped_paths=False, **kwargs):
         super().__init__()
 
         self.num_classes = num_classes
@@ -1283,11 +1751,21 @@ class TransNuSeg(nn.Module):
         self.num_features_up = int(embed_dim * 2)
         self.mlp_ratio = mlp_ratio
         self.final_upsample = final_upsample
+        self.share_encoder = share_encoder
+        self.independent_dropout = independent_dropout
+        self.share_edge_trunk = share_edge_trunk
+        self.dynamic_shape = dynamic_shape
+        self.inference_only = False
+        self.window_size = window_size
+        self.heads = HEADS if heads is None else tuple(heads)
+        assert not (dynamic_shape and ape), "absolute position embedding needs a fixed input size"
+        # every windowed stage (down to 1/(patch_size*2**(num_layers-2))) has to split into whole windows
+        self.pad_multiple = patch_size * 2 ** (self.num_layers - 2) * window_size
 
         # split image into non-overlapping patches
         self.patch_embed = PatchEmbed(
             img_size=img_size, patch_size=patch_size, in_chans=in_chans, embed_dim=embed_dim,
-            norm_layer=norm_layer if self.patch_norm else None)
+            norm_layer=norm_layer if self.patch_norm else None, strict_img_size=not dynamic_shape)
         num_patches = self.patch_embed.num_patches
         patches_resolution = self.patch_embed.patches_resolution
         self.patches_resolution = patches_resolution
@@ -1328,7 +1806,8 @@ class TransNuSeg(nn.Module):
                 layer = shiftedBlock(
                     dim=int(embed_dim * 2 ** i_layer), num_heads=num_heads[i_layer], mlp_ratio=1, qkv_bias=qkv_bias, qk_scale=qk_scale,
                     drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[sum(depths[:i_layer]):sum(depths[:i_layer + 1])][0],
-                    norm_layer=norm_layer,sr_ratio=8,input_resolution=(patches_resolution[0] // (2 ** i_layer),patches_resolution[1] // (2 ** i_layer)))
+                    norm_layer=norm_layer,sr_ratio=8,input_resolution=(patches_resolution[0] // (2 ** i_layer),patches_resolution[1] // (2 ** i_layer)),
+                    use_checkpoint=use_checkpoint)
             self.layers.append(layer)
             
         
@@ -1462,6 +1941,17 @@ class TransNuSeg(nn.Module):
             self.output3 = nn.Conv2d(in_channels=embed_dim,out_channels=self.num_classes,kernel_size=1,bias=False)
 
         self.apply(self._init_weights)
+        self.set_attn_backend(attn_backend)
+        self.set_sparse_windows(sparse_threshold, sparse_dilation)
+        self.set_skip_dropped_paths(skip_dropped_paths)
+        # logits written to the pixels of skipped windows in the sparse window mode
+        sparse_background = torch.zeros(num_classes)
+        sparse_background[0] = SPARSE_BACKGROUND_LOGIT
+        self.register_buffer("sparse_background", sparse_background, persistent=False)
+        # frozen attention biases are stale once new weights are loaded
+        self.register_load_state_dict_post_hook(TransNuSeg._unfreeze_after_load)
+        # older checkpoints still carry the derived buffers
+        self._register_load_state_dict_pre_hook(TransNuSeg._drop_derived_buffers)
 
     def _init_weights(self, m):
         if isinstance(m, nn.Linear):
@@ -1472,6 +1962,188 @@ class TransNuSeg(nn.Module):
             nn.init.constant_(m.bias, 0)
             nn.init.constant_(m.weight, 1.0)
 
+    def set_skip_dropped_paths(self, skip_dropped_paths=True):
+        """
+        Training only: stochastic depth runs the attention / MLP branches of the Swin and shifted blocks on the
+        kept samples only instead of zeroing the output of the dropped ones, see drop_path_residual. The shared
+        edge decoder blocks keep the masked DropPath, their shared / private qkv split depends on the batch layout.
+        """
+        for m in self.modules():
+            if isinstance(m, (SwinTransformerBlock, SwinTransformerBlock_up, shiftedBlock)):
+                m.skip_dropped_paths = skip_dropped_paths
+        return self
+
+    def freeze_attention_bias(self):
+        """
+        Inference only: cache the relative position bias (plus the shift mask) of every window attention block.
+        The cache is dropped again by train(), load_state_dict() or unfreeze_attention_bias().
+        """
+        for m in self.modules():
+            if isinstance(m, (SwinTransformerBlock, SwinTransformerBlock_up, Shared_SwinTransformerBlock)):
+                freeze_window_attention(m)
+        return self
+
+    def unfreeze_attention_bias(self):
+        for m in self.modules():
+            if isinstance(m, (SwinTransformerBlock, SwinTransformerBlock_up, Shared_SwinTransformerBlock)):
+                unfreeze_window_attention(m)
+        return self
+
+    @staticmethod
+    def _unfreeze_after_load(module, incompatible_keys):
+        module.unfreeze_attention_bias()
+
+    @staticmethod
+    def _drop_derived_buffers(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        for key in [k for k in state_dict if k.startswith(prefix) and k.rsplit(".", 1)[-1] in DERIVED_BUFFERS]:
+            del state_dict[key]
+
+    def _apply(self, fn, *args, **kwargs):
+        super()._apply(fn, *args, **kwargs)
+        return intern_shared_buffers(self)
+
+    def train(self, mode=True):
+        if mode:
+            if self.inference_only:
+                raise RuntimeError("the model was transformed by fuse_for_inference and can not be trained")
+            self.unfreeze_attention_bias()
+        return super().train(mode)
+
+    def fuse_for_inference(self, example_input=None, atol=1e-4):
+        """
+        Returns an eval-only copy with the inference constants folded into the weights:
+            - the attention scale into the q rows of qkv,
+            - the LayerNorm affine in front of qkv (norm1) and fc1 (norm2) into those linears, so the shared qkv
+              of the decoders is untied per block,
+            - every concat_back_dim linear into a ConcatLinear (two accumulated GEMMs instead of cat + GEMM),
+            - the relative position bias, see freeze_attention_bias.
+        The copy is checked against this model on example_input (a random image by default) and
+        returns: fused model, report dict with the fold counts and the max abs difference of every output
+        """
+        fused = intern_shared_buffers(copy.deepcopy(self).eval())
+        report = {"folded_scales": 0, "folded_norms": 0, "concat_linears": 0}
+        with torch.no_grad():
+            for m in fused.modules():
+                if not isinstance(m, (SwinTransformerBlock, SwinTransformerBlock_up, Shared_SwinTransformerBlock)):
+                    continue
+                if not (isinstance(m.norm1, nn.LayerNorm) and isinstance(m.norm2, nn.LayerNorm)):
+                    continue
+                attn, scale = m.attn, m.attn.scale
+                norm1 = m.norm1
+                m.norm1, attn.qkv = fold_layernorm(norm1, attn.qkv, q_scale=scale)
+                if isinstance(attn, SharedWindowAttention):
+                    _, attn.shared_qkv = fold_layernorm(norm1, attn.shared_qkv, q_scale=scale)
+                attn.scale = 1.
+                m.norm2, m.mlp.fc1 = fold_layernorm(m.norm2, m.mlp.fc1)
+                report["folded_scales"] += 1
+                report["folded_norms"] += 2
+
+            # concat_back_dim2/3 share their linears for all but the last stage
+            concat_linears = {}
+            for concat_back_dim in (fused.concat_back_dim, fused.concat_back_dim2, fused.concat_back_dim3):
+                for inx, linear in enumerate(concat_back_dim):
+                    if not isinstance(linear, nn.Linear):
+                        continue
+                    if id(linear) not in concat_linears:
+                        concat_linears[id(linear)] = ConcatLinear(linear, linear.in_features // 2)
+                        report["concat_linears"] += 1
+                    concat_back_dim[inx] = concat_linears[id(linear)]
+
+        fused.requires_grad_(False)
+        fused.freeze_attention_bias()
+        fused.inference_only = True
+
+        if example_input is None:
+            device = next(self.parameters()).device
+            H, W = self.patch_embed.img_size
+            example_input = torch.rand(1, self.patch_embed.in_chans, H, W, device=device)
+        training = self.training
+        self.eval()
+        with torch.no_grad():
+            reference = self(example_input)
+            outputs = fused(example_input)
+        self.train(training)
+        report["max_abs_diff"] = {name: (a - b).abs().max().item() for name, a, b in zip(self.heads, reference, outputs)}
+        report["parity"] = all(diff <= atol for diff in report["max_abs_diff"].values())
+        return fused, report
+
+    def set_sparse_windows(self, threshold=0.1, dilation=None):
+        """
+        Enables the sparse window mode (inference only), threshold None turns it off again.
+        """
+        self.sparse_threshold = threshold
+        self.sparse_dilation = self.window_size if dilation is None else dilation
+        return self
+
+    def active_tokens(self, x):
+        """
+        Sparse window mode: foreground token maps of every stage resolution, dict of (H, W) -> B, H*W bool
+        """
+        active = foreground_tokens(x, self.patch_embed.patch_size[0], self.sparse_threshold, self.sparse_dilation)
+        active = active.unsqueeze(1).float()
+        stages = {}
+        for inx in range(self.num_layers):
+            stage = F.max_pool2d(active, 2 ** inx) if inx > 0 else active
+            stages[tuple(stage.shape[-2:])] = stage.flatten(1) > 0
+        return stages
+
+    def checkpoint_stages(self):
+        """
+        Stages that can be checkpointed, dict of name -> modules: "encoder.0" ... "encoder.2", "bottleneck",
+        "decoder.1" ... "decoder.3" (nuclei) and "edge_decoder.1" ... "edge_decoder.3" (both edge decoders)
+        """
+        stages = {}
+        for inx, layer in enumerate(self.layers):
+            stages["bottleneck" if isinstance(layer, shiftedBlock) else f"encoder.{inx}"] = [layer]
+        for inx in range(1, len(self.layers_up)):
+            stages[f"decoder.{inx}"] = [self.layers_up[inx]]
+            edge = [self.layers_up2[inx]]
+            if self.layers_up3[inx] is not self.layers_up2[inx]:
+                edge.append(self.layers_up3[inx])
+            stages[f"edge_decoder.{inx}"] = edge
+        return stages
+
+    def set_checkpoint_policy(self, policy="none", memory_budget_mb=None, example_input=None, batch_size=None):
+        """
+        Activation checkpointing per stage, see checkpoint_stages.
+        Args:
+            policy: "none", "all", a list (or comma separated string) of stage names or prefixes such as
+                "encoder", or "auto" to checkpoint the fewest stages that bring the estimated peak training memory
+                under memory_budget_mb
+            memory_budget_mb (float): budget of the "auto" policy
+            example_input: B, C, H, W input the "auto" policy profiles the activations with (a single image is
+                enough, see batch_size)
+            batch_size (int): training batch size the profiled activations are scaled to, default the batch size
+                of example_input
+        Returns:
+            names of the checkpointed stages
+        """
+        stages = self.checkpoint_stages()
+        if policy == "auto":
+            assert memory_budget_mb is not None and example_input is not None, \
+                "the auto checkpoint policy needs memory_budget_mb and example_input"
+            selected = select_checkpoint_stages(self, stages, example_input, memory_budget_mb * 2 ** 20, batch_size)
+        elif policy in (None, "none"):
+            selected = []
+        elif policy == "all":
+            selected = list(stages)
+        else:
+            prefixes = policy.split(",") if isinstance(policy, str) else list(policy)
+            unknown = [p for p in prefixes if not any(name == p or name.startswith(p + ".") for name in stages)]
+            assert not unknown, f"unknown checkpoint stages {unknown}, choose from {list(stages)}"
+            selected = [name for name in stages if any(name == p or name.startswith(p + ".") for p in prefixes)]
+        for name, modules in stages.items():
+            for m in modules:
+                m.use_checkpoint = name in selected
+        return selected
+
+    def set_attn_backend(self, attn_backend):
+        assert attn_backend in ATTN_BACKENDS, f"attn_backend must be one of {ATTN_BACKENDS}"
+        for m in self.modules():
+            if isinstance(m, (WindowAttention, WindowAttention_up, SharedWindowAttention)):
+                m.attn_backend = attn_backend
+        return self
+
     @torch.jit.ignore
     def no_weight_decay(self):
         return {'absolute_pos_embed'}
@@ -1481,22 +2153,40 @@ class TransNuSeg(nn.Module):
         return {'relative_position_bias_table'}
 
     #Encoder and Bottleneck
-    def forward_features(self, x):
+    def _encode_stage(self, layer, x, H, W, active=None):
+        if active is not None and isinstance(layer, BasicLayer):
+            return layer(x, H, W, active)
+        return layer(x, H, W)
+
+    def forward_features(self, x, active=None):
+        # active: sparse window mode, see active_tokens
+        H, W = x.shape[2] // self.patch_embed.patch_size[0], x.shape[3] // self.patch_embed.patch_size[1]
         x = self.patch_embed(x)
         if self.ape:
             x = x + self.absolute_pos_embed
+
+        if self.share_encoder and not (self.training and self.independent_dropout):
+            # both decoder families read the same features, so the encoder only has to run once
+            x = self.pos_drop(x)
+            x_downsample = []
+            for inx, layer in enumerate(self.layers):
+                x_downsample.append(x)
+                x = self._encode_stage(layer, x, H // 2 ** inx, W // 2 ** inx, active)
+            x = self.norm(x)  # B L C
+            return x, x, x_downsample, x_downsample
+
         seg_mask = self.pos_drop(x)
         edge_mask = self.pos_drop(x)
 
         seg_mask_downsample = []
         edge_mask_downsample = []
 
-        for layer in self.layers:
+        for inx, layer in enumerate(self.layers):
             edge_mask_downsample.append(edge_mask)
             seg_mask_downsample.append(seg_mask)
             
-            seg_mask = layer(seg_mask)
-            edge_mask = layer(edge_mask)
+            seg_mask = self._encode_stage(layer, seg_mask, H // 2 ** inx, W // 2 ** inx, active)
+            edge_mask = self._encode_stage(layer, edge_mask, H // 2 ** inx, W // 2 ** inx, active)
             
             
 
@@ -1507,70 +2197,143 @@ class TransNuSeg(nn.Module):
   
         return seg_mask,edge_mask, seg_mask_downsample,edge_mask_downsample
 
+    def _edge_stage_shared(self, inx):
+        # normal and cluster edge decoders hold the very same modules for every stage but the last one
+        return self.layers_up2[inx] is self.layers_up3[inx] and self.concat_back_dim2[inx] is self.concat_back_dim3[inx]
+
+    def _decode_stage(self, concat_back_dim, layers_up, inx, x, x_downsample, H, W, active=None):
+        if inx > 0:
+            # skip connection of the matching encoder stage, counted from the end
+            if isinstance(concat_back_dim[inx], ConcatLinear):
+                x = concat_back_dim[inx](x, x_downsample[-1-inx])
+            else:
+                x = torch.cat([x,x_downsample[-1-inx]],-1)
+                x = concat_back_dim[inx](x)
+        if active is not None and isinstance(layers_up[inx], BasicLayer_up):
+            return layers_up[inx](x, H, W, active)
+        return layers_up[inx](x, H, W)
+
     #Dencoder and Skip connection
-    def forward_up_features(self, seg_mask,edge_mask, seg_mask_downsample,edge_mask_downsample):
+    def forward_up_features(self, seg_mask,edge_mask, seg_mask_downsample,edge_mask_downsample, H=None, W=None, heads=None,
+                            active=None):
         # #print("forward ",self.layers_up2[0])
+        # H, W: token resolution of the first stage, i.e. image size // patch size
+        # heads: subset of HEADS to decode, the branches of the other heads return None
+        # active: sparse window mode, applied to the nuclei decoder only (the edge decoders share their blocks)
+        if H is None:
+            H, W = self.patches_resolution
+        heads = self.heads if heads is None else heads
+        if "nuclei" not in heads:
+            seg_mask = None
+        if "normal_edge" not in heads and "cluster_edge" not in heads:
+            edge_mask = None
+        cluster_edge = edge_mask
+        # the shared edge trunk is computed once unless each branch has to draw its own dropout masks
+        share_edge_trunk = self.share_edge_trunk and not (self.training and self.independent_dropout)
         for inx in range(len(self.layers_up)):
-            if inx == 0:
-                seg_mask = self.layers_up[inx](seg_mask)
-                cluster_edge = self.layers_up3[inx](edge_mask)
-                edge_mask = self.layers_up2[inx](edge_mask)
+            H_inx, W_inx = H // 2 ** (self.num_layers-1-inx), W // 2 ** (self.num_layers-1-inx)
+            if seg_mask is not None:
+                seg_mask = self._decode_stage(self.concat_back_dim, self.layers_up, inx, seg_mask, seg_mask_downsample, H_inx, W_inx, active)
+
+            if edge_mask is None and cluster_edge is None:
+                continue
+            if share_edge_trunk and cluster_edge is edge_mask and self._edge_stage_shared(inx):
+                edge_mask = self._decode_stage(self.concat_back_dim2, self.layers_up2, inx, edge_mask, edge_mask_downsample, H_inx, W_inx)
+                cluster_edge = edge_mask
+                continue
+            if cluster_edge is not None and "cluster_edge" in heads:
+                cluster_edge = self._decode_stage(self.concat_back_dim3, self.layers_up3, inx, cluster_edge, edge_mask_downsample, H_inx, W_inx)
             else:
-                #print("shape ",seg_mask.shape,seg_mask_downsample[3-inx].shape)
-                seg_mask = torch.cat([seg_mask,seg_mask_downsample[3-inx]],-1)
-                seg_mask = self.concat_back_dim[inx](seg_mask)
-                seg_mask = self.layers_up[inx](seg_mask)
-
-                edge_mask = torch.cat([edge_mask,edge_mask_downsample[3-inx]],-1)
-                edge_mask = self.concat_back_dim2[inx](edge_mask)
-                edge_mask = self.layers_up2[inx](edge_mask)
-
-                cluster_edge = torch.cat([cluster_edge,edge_mask_downsample[3-inx]],-1)
-                cluster_edge = self.concat_back_dim3[inx](cluster_edge)
-                cluster_edge = self.layers_up3[inx](cluster_edge)
-        
+                cluster_edge = None
+            if edge_mask is not None and "normal_edge" in heads:
+                edge_mask = self._decode_stage(self.concat_back_dim2, self.layers_up2, inx, edge_mask, edge_mask_downsample, H_inx, W_inx)
+            else:
+                edge_mask = None
 
-        seg_mask = self.norm_up(seg_mask)
-        edge_mask = self.norm_up2(edge_mask)  # B L C
-        cluster_edge = self.norm_up3(cluster_edge)
+        seg_mask = None if seg_mask is None else self.norm_up(seg_mask)
+        edge_mask = None if edge_mask is None else self.norm_up2(edge_mask)  # B L C
+        cluster_edge = None if cluster_edge is None else self.norm_up3(cluster_edge)
   
         return seg_mask,edge_mask,cluster_edge
 
-    def up_x4(self, seg_mask,edge_mask,cluster_edge):
-        H, W = self.patches_resolution
-        B, L, C = seg_mask.shape
-        assert L == H*W, "input features has wrong size"
+    def up_x4(self, seg_mask,edge_mask,cluster_edge, H=None, W=None, active=None):
+        # branches passed as None (heads that were not requested) are skipped
+        # active: sparse window mode, only the foreground tokens are expanded, see sparse_final_expand
+        if H is None:
+            H, W = self.patches_resolution
+
+        if active is not None and self.final_upsample=="expand_first":
+            branches = ((self.up, self.output), (self.up2, self.output2), (self.up3, self.output3))
+            return tuple(None if x is None else sparse_final_expand(up, output, x, H, W, active[(H, W)], self.sparse_background)
+                         for x, (up, output) in zip((seg_mask, edge_mask, cluster_edge), branches))
 
         if self.final_upsample=="expand_first":
-            seg_mask = self.up(seg_mask)
-            seg_mask = seg_mask.view(B,4*H,4*W,-1)
-            seg_mask = seg_mask.permute(0,3,1,2) #B,C,H,W
-            seg_mask = self.output(seg_mask)
-
-            edge_mask = self.up2(edge_mask)
-            edge_mask = edge_mask.view(B,4*H,4*W,-1)
-            edge_mask = edge_mask.permute(0,3,1,2) #B,C,H,W
-            edge_mask = self.output2(edge_mask)
-
-            cluster_edge = self.up3(cluster_edge)
-            cluster_edge = cluster_edge.view(B,4*H,4*W,-1)
-            cluster_edge = cluster_edge.permute(0,3,1,2) #B,C,H,W
-            cluster_edge = self.output3(cluster_edge)
+            if seg_mask is not None:
+                B, L, C = seg_mask.shape
+                torch._assert(L == H*W, "input features has wrong size")
+                seg_mask = self.up(seg_mask, H, W)
+                seg_mask = seg_mask.view(B,4*H,4*W,-1)
+                seg_mask = seg_mask.permute(0,3,1,2) #B,C,H,W
+                seg_mask = self.output(seg_mask)
+
+            if edge_mask is not None:
+                B, L, C = edge_mask.shape
+                edge_mask = self.up2(edge_mask, H, W)
+                edge_mask = edge_mask.view(B,4*H,4*W,-1)
+                edge_mask = edge_mask.permute(0,3,1,2) #B,C,H,W
+                edge_mask = self.output2(edge_mask)
+
+            if cluster_edge is not None:
+                B, L, C = cluster_edge.shape
+                cluster_edge = self.up3(cluster_edge, H, W)
+                cluster_edge = cluster_edge.view(B,4*H,4*W,-1)
+                cluster_edge = cluster_edge.permute(0,3,1,2) #B,C,H,W
+                cluster_edge = self.output3(cluster_edge)
         # #print("up_x4 x size ",x.shape)
         return seg_mask,edge_mask,cluster_edge
 
-    def forward(self, x):
-        seg_mask,edge_mask, seg_mask_downsample,edge_mask_downsample = self.forward_features(x)
+    def pad_input(self, x):
+        """
+        Dynamic shape mode: replicate-pad B, C, H, W images to a multiple of pad_multiple
+        """
+        H, W = x.shape[-2:]
+        pad_h = (self.pad_multiple - H % self.pad_multiple) % self.pad_multiple
+        pad_w = (self.pad_multiple - W % self.pad_multiple) % self.pad_multiple
+        if pad_h == 0 and pad_w == 0:
+            return x
+        return F.pad(x, (0, pad_w, 0, pad_h), mode="replicate")
+
+    def forward(self, x, heads=None):
+        """
+        Args:
+            x: B, C, H, W images
+            heads: subset of HEADS ("nuclei", "normal_edge", "cluster_edge") to compute, default self.heads.
+                Decoder branches and final expansions of the other heads are skipped.
+        Returns:
+            the logits of the requested heads in HEADS order, each B, num_classes, H, W
+        """
+        heads = self.heads if heads is None else heads
+        torch._assert(all(name in HEADS for name in heads), f"heads must be a subset of {HEADS}")
+        H_in, W_in = x.shape[-2:]
+        if self.dynamic_shape:
+            x = self.pad_input(x)
+        H, W = x.shape[2] // self.patch_embed.patch_size[0], x.shape[3] // self.patch_embed.patch_size[1]
+        active = self.active_tokens(x) if self.sparse_threshold is not None and not self.training else None
+
+        seg_mask,edge_mask, seg_mask_downsample,edge_mask_downsample = self.forward_features(x, active)
 
         # #print("downsampling, ")
 
-        seg_mask,edge_mask,cluster_edge = self.forward_up_features(seg_mask,edge_mask, seg_mask_downsample,edge_mask_downsample)
+        seg_mask,edge_mask,cluster_edge = self.forward_up_features(seg_mask,edge_mask, seg_mask_downsample,edge_mask_downsample, H, W, heads, active)
         # #print("forward features ", seg_mask.shape,edge_mask.shape,cluster_edge.shape)
 
-        seg_mask,edge_mask,cluster_edge = self.up_x4(seg_mask,edge_mask,cluster_edge)
+        seg_mask,edge_mask,cluster_edge = self.up_x4(seg_mask,edge_mask,cluster_edge, H, W, active)
         
+        outputs = [output for name, output in zip(HEADS, (seg_mask,edge_mask,cluster_edge)) if name in heads]
+        if self.dynamic_shape and (x.shape[2] != H_in or x.shape[3] != W_in):
+            outputs = [output[:, :, :H_in, :W_in] for output in outputs]
 
-        return seg_mask,edge_mask,cluster_edge
+        return tuple(outputs)
 
     def flops(self):
         flops = 0
@@ -0,0 +1,59 @@
+'''
+Export of the three-head TransNuSeg to ONNX for the CPU runtime in onnx_inference.py.
+
+The graph takes a float (batch, in_chans, img_size, img_size) image in [0, 1] and returns the nuclei, normal edge
+and cluster edge logits, each (batch, num_classes, img_size, img_size); the batch axis is dynamic. The relative
+position bias and shift masks are frozen into constants and attention uses the plain softmax formulation, so the
+graph only needs standard opset ops (the cyclic shifts are precomputed gathers, the patch expansions are
+Reshape / Transpose).
+
+    python onnx_export.py --model_path=./saved/model.pt --output=./saved/model.onnx
+'''
+import argparse
+import logging
+import sys
+
+import torch
+
+from model_io import load_checkpoint
+from models.transnuseg import HEADS, TransNuSeg
+
+
+INPUT_NAME = "image"
+
+
+def export_onnx(model, path, img_size=512, in_chans=3, opset=17):
+    '''
+    model: TransNuSeg, exported in eval mode with the frozen relative position bias and the math attention backend
+    '''
+    model.eval()
+    model.set_attn_backend("math")
+    model.freeze_attention_bias()
+    x = torch.rand(1, in_chans, img_size, img_size, device=next(model.parameters()).device)
+    dynamic_axes = {name: {0: "batch"} for name in (INPUT_NAME,) + HEADS}
+    with torch.no_grad():
+        torch.onnx.export(model, (x,), path, input_names=[INPUT_NAME], output_names=list(HEADS),
+                          dynamic_axes=dynamic_axes, opset_version=opset, do_constant_folding=True)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path", required=True, help="the path to the trained model")
+    parser.add_argument("--output", required=True, help="path of the .onnx file to write")
+    parser.add_argument("--in_chans", type=int, default=3, help="3 for Histology, 1 for Radiology")
+    parser.add_argument("--img_size", type=int, default=512, help="model input size")
+    parser.add_argument("--opset", type=int, default=17, help="ONNX opset version")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s.%(msecs)03d] %(message)s', datefmt='%H:%M:%S',
+                        handlers=[logging.StreamHandler(sys.stdout)])
+
+    model = TransNuSeg(img_size=args.img_size, in_chans=args.in_chans)
+    load_checkpoint(model, args.model_path, map_location="cpu")
+    export_onnx(model, args.output, args.img_size, args.in_chans, args.opset)
+    logging.info("exported to {}".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+'''
+ONNX Runtime inference of an exported TransNuSeg (see onnx_export.py) for CPU workers.
+
+Only needs numpy, Pillow, opencv-python and onnxruntime: images are read as in MyDataset (RGB or grayscale,
+scaled to [0, 1], channels first) and instances are extracted as in utils.sem2ins (nuclei minus normal and
+cluster edges, filled contours).
+
+    python onnx_inference.py --model=./saved/model.onnx --image=./data/histology/test/data/1.png --output=./1.npy
+'''
+import argparse
+import time
+
+import cv2
+import numpy as np
+import onnxruntime as ort
+from PIL import Image
+
+
+HEADS = ("nuclei", "normal_edge", "cluster_edge")
+
+
+def load_image(path, in_chans=3):
+    '''
+    C, H, W float32 image in [0, 1], as MyDataset followed by to_float_image
+    '''
+    img = Image.open(path).convert("RGB" if in_chans == 3 else "L")
+    img = np.asarray(img, dtype=np.float32) / 255.
+    return img.transpose(2, 0, 1) if img.ndim == 3 else img[None]
+
+
+def sem2ins(seg_mask, nem, cem):
+    '''
+    instance labels from the nuclei, normal edge and cluster edge masks as utils.sem2ins (sharpen=0), numbering
+    the filled contours from 1 so that 0 stays background
+    '''
+    result = (seg_mask.astype(np.int16) - nem - cem > 0).astype(np.uint8)
+    contours, _ = cv2.findContours(result, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    instances = np.zeros(result.shape, np.int32)
+    for i, cnt in enumerate(contours):
+        cv2.drawContours(instances, [cnt], 0, i + 1, -1)
+    return instances
+
+
+class OnnxPredictor:
+    '''
+    path: exported .onnx model
+    num_threads: intra-op threads of the session, default onnxruntime's choice
+    '''
+    def __init__(self, path, num_threads=None, providers=("CPUExecutionProvider",)):
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options, providers=list(providers))
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, images):
+        '''
+        images: B, C, H, W float array in [0, 1]
+        returns the nuclei, normal edge and cluster edge logits, each B, num_classes, H, W
+        '''
+        return tuple(self.session.run(list(HEADS), {self.input_name: np.ascontiguousarray(images, np.float32)}))
+
+    def predict(self, image):
+        '''
+        image: C, H, W float array in [0, 1]
+        returns the nuclei, normal edge and cluster edge masks and the instance labels, each H, W
+        '''
+        seg_mask, nem, cem = (logits[0].argmax(0).astype(np.uint8) for logits in self(image[None]))
+        return seg_mask, nem, cem, sem2ins(seg_mask, nem, cem)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", required=True, help="the exported .onnx model")
+    parser.add_argument("--image", required=True, help="image to segment, of the exported input size")
+    parser.add_argument("--output", required=True, help=".npy file for the (4, H, W) nuclei, edges and instance maps")
+    parser.add_argument("--in_chans", type=int, default=3, help="3 for Histology, 1 for Radiology")
+    parser.add_argument("--num_threads", type=int, default=None, help="intra-op threads")
+    args = parser.parse_args()
+
+    predictor = OnnxPredictor(args.model, args.num_threads)
+    s = time.time()
+    outputs = predictor.predict(load_image(args.image, args.in_chans))
+    np.save(args.output, np.stack(outputs).astype(np.int32))
+    print("{} instances in {:.3f}s, written to {}".format(outputs[3].max(), time.time() - s, args.output))
+
+
+if __name__ == '__main__':
+    main()
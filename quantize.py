@@ -0,0 +1,213 @@
+'''
+Post-training INT8 quantization of TransNuSeg for CPU inference.
+
+Almost all of the work of TransNuSeg is in nn.Linear layers (qkv, proj, Mlp fc1/fc2, PatchExpand.expand and the
+16x FinalPatchExpand_X4.expand), so only those are quantized, the convolutions and LayerNorms stay in float:
+
+    dynamic: int8 weights, activations quantized on the fly per call, no calibration needed
+    static:  int8 weights and activations, activation ranges calibrated on a sample folder read with MyDataset
+
+The float model is first passed through fuse_for_inference. Both precisions are evaluated next to the float model
+on the same folder and reported with Dice, AJI and PQ deltas, latency and model size. The instances of AJI and PQ
+are extracted from the nuclei, normal edge and cluster edge masks as in utils.sem2ins (see sem2ins_labels).
+
+    python quantize.py --model_path=./saved/model.pt --data_path=./data/histology/test --mode=both
+'''
+import argparse
+import copy
+import io
+import logging
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.ao.nn.quantized.dynamic as nnqd
+from torch.ao.quantization import DeQuantStub, QuantStub
+
+from dataset import MyDataset, to_float_image
+from model_io import load_checkpoint
+from models.transnuseg import TransNuSeg
+from utils import get_fast_aji, get_fast_pq, sem2ins_labels
+
+
+MODES = ("dynamic", "static")
+
+
+class QuantLinear(nn.Module):
+    '''
+    nn.Linear between a QuantStub and a DeQuantStub, so that eager mode static quantization can swap it for a
+    quantized Linear while the rest of the model keeps working on float tensors
+    '''
+    def __init__(self, linear):
+        super().__init__()
+        self.quant = QuantStub()
+        self.linear = linear
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.linear(self.quant(x)))
+
+
+def swap_linears(model, make):
+    '''
+    replaces every nn.Linear child by make(linear). Linears held by several modules (the qkv shared by the decoders,
+    the modules shared by the edge decoders) are swapped once, so the quantized model keeps the sharing.
+    returns the new modules
+    '''
+    swapped = {}
+    for m in list(model.modules()):
+        for name, child in m.named_children():
+            if type(child) is not nn.Linear:
+                continue
+            if id(child) not in swapped:
+                swapped[id(child)] = make(child)
+            m._modules[name] = swapped[id(child)]
+    return list(swapped.values())
+
+
+def quantize_dynamic(model):
+    model = copy.deepcopy(model)
+
+    def make(linear):
+        linear.qconfig = torch.ao.quantization.default_dynamic_qconfig
+        return nnqd.Linear.from_float(linear)
+
+    swap_linears(model, make)
+    return model
+
+
+@torch.no_grad()
+def quantize_static(model, calibration_batches, engine=None):
+    '''
+    calibration_batches: iterable of float input batches used to observe the activation ranges
+    '''
+    engine = engine or torch.backends.quantized.engine
+    model = copy.deepcopy(model)
+    wrappers = swap_linears(model, QuantLinear)
+    for wrapper in wrappers:
+        wrapper.qconfig = torch.ao.quantization.get_default_qconfig(engine)
+        torch.ao.quantization.prepare(wrapper, inplace=True)
+    for x in calibration_batches:
+        model(x)
+    for wrapper in wrappers:
+        torch.ao.quantization.convert(wrapper, inplace=True)
+    return model
+
+
+def model_size(model):
+    '''
+    serialized size of the state_dict in bytes, shared tensors counted once
+    '''
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return buf.tell()
+
+
+def remap_label(instances):
+    # contiguous instance ids as required by get_fast_aji / get_fast_pq, 0 stays background
+    ids, inverse = np.unique(instances, return_inverse=True)
+    inverse = inverse.reshape(instances.shape)
+    return inverse if ids[0] == 0 else inverse + 1
+
+
+def dice(prediction, label):
+    total = prediction.sum() + label.sum()
+    return 1. if total == 0 else 2. * (prediction * label).sum() / total
+
+
+@torch.no_grad()
+def evaluate(model, samples, repeat=1):
+    '''
+    samples: list of (img, instance_mask, semantic_mask) with img of shape (1, C, H, W)
+    returns mean Dice of the nuclei mask, AJI and PQ of the sem2ins instances and the mean latency per image in seconds
+    '''
+    scores = {"dice": [], "aji": [], "pq": []}
+    seconds = 0.
+    for img, instance_mask, semantic_mask in samples:
+        s = time.perf_counter()
+        for _ in range(repeat):
+            outputs = model(img)
+        seconds += (time.perf_counter() - s) / repeat
+        logits = torch.stack(outputs, 1)[0].float().numpy()  # 3, num_classes, H, W
+        seg_mask, nem, cem = logits.argmax(1).astype(np.uint8)
+        instances = remap_label(sem2ins_labels(seg_mask, nem, cem))  # contours filled over holes drop their ids
+        scores["dice"].append(dice(seg_mask, semantic_mask))
+        if instance_mask.max() == 0 or instances.max() == 0:
+            continue
+        true = remap_label(instance_mask)
+        scores["aji"].append(get_fast_aji(true, instances))
+        scores["pq"].append(get_fast_pq(true, instances)[0][2])
+    results = {name: float(np.nanmean(values)) if values else float("nan") for name, values in scores.items()}
+    results["latency"] = seconds / len(samples)
+    return results
+
+
+def load_samples(data_path, in_chans, start, count):
+    dataset = MyDataset(data_path, in_chan=in_chans)
+    samples = []
+    for index in range(start, min(start + count, len(dataset)) if count else len(dataset)):
+        img, instance_mask, semantic_mask, _, _ = dataset[index]
+        samples.append((to_float_image(img).unsqueeze(0), instance_mask.numpy(), semantic_mask.numpy()))
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path", required=True, help="the path to the trained model")
+    parser.add_argument("--data_path", required=True, help="folder with data and label subfolders, as read by MyDataset")
+    parser.add_argument("--calibration_path", default=None, help="calibration folder, default the first images of data_path")
+    parser.add_argument("--in_chans", type=int, default=3, help="3 for Histology, 1 for Radiology")
+    parser.add_argument("--img_size", type=int, default=512, help="model input size")
+    parser.add_argument("--mode", default="both", choices=MODES + ("both",), help="quantization to run")
+    parser.add_argument("--num_calibration", type=int, default=16, help="number of calibration images")
+    parser.add_argument("--num_eval", type=int, default=0, help="number of evaluation images, 0 for all")
+    parser.add_argument("--repeat", type=int, default=1, help="timed runs per evaluation image")
+    parser.add_argument("--engine", default=None, choices=torch.backends.quantized.supported_engines,
+                        help="quantized backend, default torch.backends.quantized.engine")
+    parser.add_argument("--output", default=None, help="prefix to torch.save the quantized models to, e.g. ./saved/model")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s.%(msecs)03d] %(message)s', datefmt='%H:%M:%S',
+                        handlers=[logging.StreamHandler(sys.stdout)])
+    if args.engine is not None:
+        torch.backends.quantized.engine = args.engine
+
+    model = TransNuSeg(img_size=args.img_size, in_chans=args.in_chans)
+    load_checkpoint(model, args.model_path, map_location="cpu")
+    model.eval()
+    model, _ = model.fuse_for_inference()
+
+    if args.calibration_path is None:
+        calibration = load_samples(args.data_path, args.in_chans, 0, args.num_calibration)
+        evaluation = load_samples(args.data_path, args.in_chans, args.num_calibration, args.num_eval)
+    else:
+        calibration = load_samples(args.calibration_path, args.in_chans, 0, args.num_calibration)
+        evaluation = load_samples(args.data_path, args.in_chans, 0, args.num_eval)
+
+    models = {"float32": model}
+    modes = MODES if args.mode == "both" else (args.mode,)
+    if "dynamic" in modes:
+        models["dynamic int8"] = quantize_dynamic(model)
+    if "static" in modes:
+        models["static int8"] = quantize_static(model, [img for img, _, _ in calibration], args.engine)
+
+    reference = None
+    logging.info("{:<14} {:>7} {:>7} {:>7} {:>8} {:>8} {:>8} {:>10} {:>8} {:>9}".format(
+        "precision", "Dice", "AJI", "PQ", "dDice", "dAJI", "dPQ", "latency", "speed-up", "size MB"))
+    for name, m in models.items():
+        results = evaluate(m, evaluation, args.repeat)
+        reference = reference or results
+        logging.info("{:<14} {:>7.4f} {:>7.4f} {:>7.4f} {:>+8.4f} {:>+8.4f} {:>+8.4f} {:>9.4f}s {:>7.2f}x {:>9.1f}".format(
+            name, results["dice"], results["aji"], results["pq"],
+            results["dice"] - reference["dice"], results["aji"] - reference["aji"], results["pq"] - reference["pq"],
+            results["latency"], reference["latency"] / results["latency"], model_size(m) / 2 ** 20))
+        if args.output is not None and m is not model:
+            path = "{}_{}.pt".format(args.output, name.split()[0])
+            torch.save(m, path)
+            logging.info("saved {}".format(path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,422 @@
+'''
+Tiled inference of TransNuSeg on images larger than the model input.
+
+The image is cut into tile_size tiles that overlap by 2*halo pixels, the tiles are pushed through the model in
+batches and the three logit maps (nuclei, normal edge, cluster edge) are blended with a weighted window into one
+full-size canvas of shape (3, num_classes, H, W). The image is kept as uint8 (or read from a memory-mapped .npy
+file) and only converted to float tile by tile, and with an output path the canvas is a memory-mapped .npy file, so
+peak memory only depends on the tile and batch size, not on the image size.
+
+Instances are extracted tile by tile as well (stitch_instances): every tile is labelled independently and in
+parallel, labels meeting in the one pixel overlap between neighbouring tiles are merged with union-find and the
+ids are renumbered globally, so the full-resolution label image is never relabelled in one piece.
+
+With --cascade_factor the image is first segmented at 1/cascade_factor resolution (predict_cascade): only tiles whose
+coarse nuclei probability exceeds --cascade_threshold get the full-resolution pass, all others are filled with
+background logits.
+
+    python tiled_inference.py --model_path=./saved/model.pt --image=./slide.png --output=./slide_logits.npy \
+        --instances=./slide_instances.npy
+'''
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+from model_io import load_checkpoint
+from models.transnuseg import HEADS, SPARSE_BACKGROUND_LOGIT, TransNuSeg
+
+
+device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+
+
+def load_image(path, in_chans=3):
+    '''
+    reads an image the same way as MyDataset: RGB or grayscale uint8, shape C, H, W (see to_float). A .npy file
+    holding a C, H, W uint8 or [0, 1] float array is memory-mapped instead of read.
+    '''
+    if path.endswith(".npy"):
+        img = np.load(path, mmap_mode="r")
+        assert img.ndim == 3 and img.shape[0] == in_chans, "expected a ({}, H, W) array, got {}".format(in_chans, img.shape)
+        return img
+    Image.MAX_IMAGE_PIXELS = None
+    img = np.asarray(Image.open(path).convert("RGB" if in_chans == 3 else "L"))
+    if img.ndim == 2:
+        img = img[None]
+    else:
+        img = img.transpose(2, 0, 1)
+    return img
+
+
+def to_float(array):
+    '''
+    float32 copy in [0, 1] of a uint8 image window, float windows are taken as they are
+    '''
+    if array.dtype == np.uint8:
+        return np.asarray(array, dtype=np.float32) / 255.
+    return np.asarray(array, dtype=np.float32)
+
+
+def tile_origins(length, tile_size, stride):
+    '''
+    start offsets of the tiles along one axis, the last tile is aligned to the border
+    '''
+    if length <= tile_size:
+        return [0]
+    origins = list(range(0, length - tile_size, stride))
+    origins.append(length - tile_size)
+    return origins
+
+
+def blend_window(tile_size, halo):
+    '''
+    separable weight window, 1 in the tile centre and ramping down linearly over the halo
+    '''
+    if halo == 0:
+        return np.ones((tile_size, tile_size), dtype=np.float32)
+    ramp = (np.arange(tile_size, dtype=np.float32) + 0.5) / halo
+    ramp = np.minimum(np.minimum(ramp, ramp[::-1]), 1.)
+    return np.outer(ramp, ramp)
+
+
+def allocate(shape, path=None, dtype=np.float32):
+    '''
+    zero initialised array, memory-mapped .npy file when a path is given
+    '''
+    if path is None:
+        return np.zeros(shape, dtype=dtype)
+    return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+
+class TiledPredictor():
+    '''
+    model: TransNuSeg in eval mode
+    tile_size: side of the square tiles fed to the model, default 512
+    halo: overlap on each side of a tile that is blended with the neighbours, default 64
+    batch_size: number of tiles per forward pass
+    '''
+    def __init__(self, model, tile_size=512, halo=64, batch_size=4, device=device):
+        assert 0 <= 2 * halo < tile_size, "the halo has to leave a non-empty tile centre"
+        self.model = model
+        self.tile_size = tile_size
+        self.halo = halo
+        self.batch_size = batch_size
+        self.device = device
+        self.window = blend_window(tile_size, halo)
+        self.stats = {}
+
+    def tiles(self, H, W):
+        stride = self.tile_size - 2 * self.halo
+        for y in tile_origins(H, self.tile_size, stride):
+            for x in tile_origins(W, self.tile_size, stride):
+                yield y, x
+
+    def read_tile(self, image, y, x):
+        tile = to_float(image[:, y:y + self.tile_size, x:x + self.tile_size])
+        _, h, w = tile.shape
+        if h < self.tile_size or w < self.tile_size:
+            tile = np.pad(tile, ((0, 0), (0, self.tile_size - h), (0, self.tile_size - w)), mode="edge")
+        return tile
+
+    @torch.no_grad()
+    def run_batch(self, tiles, heads=HEADS):
+        '''
+        heads: subset of HEADS to compute, the decoders of the others are skipped
+        '''
+        x = torch.from_numpy(np.stack(tiles)).to(self.device)
+        outputs = self.model(x, heads=heads)
+        return torch.stack(outputs, 1).float().cpu().numpy()  # B, len(heads), num_classes, tile, tile
+
+    def predict(self, image, output_path=None, tile_filter=None, heads=HEADS):
+        '''
+        image: C, H, W uint8 or [0, 1] float array (may be memory-mapped), converted to float tile by tile
+        output_path: optional .npy path, the canvas is then memory-mapped instead of held in memory
+        tile_filter: optional function (y, x) -> bool, tiles it rejects are not run and get background logits
+        heads: subset of HEADS to compute, blend and store, in HEADS order
+        returns the blended logits, shape len(heads), num_classes, H, W
+        '''
+        heads = tuple(name for name in HEADS if name in heads)
+        _, H, W = image.shape
+        canvas = allocate((len(heads), self.model.num_classes, H, W), output_path)
+        weight_file = None
+        if output_path is not None:
+            weight_file = tempfile.NamedTemporaryFile(suffix=".npy", dir=os.path.dirname(os.path.abspath(output_path)))
+        weights = allocate((H, W), None if weight_file is None else weight_file.name)
+
+        s = time.time()
+        num_tiles = num_skipped = 0
+        batch, origins = [], []
+        for y, x in self.tiles(H, W):
+            if tile_filter is not None and not tile_filter(y, x):
+                self.accumulate(canvas, weights, self.background_tile(canvas.shape[1], len(heads))[None], [(y, x)])
+                num_skipped += 1
+                continue
+            batch.append(self.read_tile(image, y, x))
+            origins.append((y, x))
+            if len(batch) == self.batch_size:
+                self.accumulate(canvas, weights, self.run_batch(batch, heads), origins)
+                num_tiles += len(batch)
+                batch, origins = [], []
+        if len(batch) > 0:
+            self.accumulate(canvas, weights, self.run_batch(batch, heads), origins)
+            num_tiles += len(batch)
+
+        self.normalise(canvas, weights)
+        e = time.time()
+        self.stats = {"tiles": num_tiles, "skipped": num_skipped, "skip_rate": num_skipped / max(num_tiles + num_skipped, 1),
+                      "seconds": e - s, "tiles_per_second": num_tiles / (e - s)}
+
+        if weight_file is not None:
+            del weights
+            weight_file.close()
+        if output_path is not None:
+            canvas.flush()
+        return canvas
+
+    def background_tile(self, num_classes, num_heads=len(HEADS)):
+        # logits of a skipped tile, the same background logits as the sparse window mode of TransNuSeg
+        logits = np.zeros((num_heads, num_classes, self.tile_size, self.tile_size), dtype=np.float32)
+        logits[:, 0] = SPARSE_BACKGROUND_LOGIT
+        return logits
+
+    def coarse_foreground(self, image, factor, coarse_model=None, rows=2048):
+        '''
+        nuclei probability of the image segmented at 1/factor resolution, shape H/factor, W/factor. Only the
+        nuclei head is computed and blended. The image is downsampled in strips of about rows rows.
+        '''
+        C, H, W = image.shape
+        w, h = max(W // factor, 1), max(H // factor, 1)
+        coarse = np.empty((C, h, w), dtype=np.float32)
+        step = max(rows // factor, 1)
+        for y in range(0, h, step):
+            y1 = min(y + step, h)
+            strip = to_float(image[:, y * factor:H if y1 == h else y1 * factor])
+            for c in range(C):
+                coarse[c, y:y1] = cv2.resize(strip[c], (w, y1 - y), interpolation=cv2.INTER_AREA)
+        predictor = TiledPredictor(coarse_model or self.model, self.tile_size, self.halo, self.batch_size, self.device)
+        logits = predictor.predict(coarse, heads=("nuclei",))[0]  # num_classes, h, w
+        logits = logits - logits.max(0, keepdims=True)
+        probability = np.exp(logits)
+        return probability[1:].sum(0) / probability.sum(0)
+
+    def predict_cascade(self, image, output_path=None, factor=4, threshold=0.5, coarse_model=None):
+        '''
+        coarse-to-fine inference: a 1/factor resolution pass (through coarse_model, default the same model) finds
+        the tiles containing nuclei, only those are segmented at full resolution
+        threshold: minimum coarse nuclei probability within a tile (halo included) for the tile to be run
+        returns the blended logits as predict, self.stats additionally holds the skip rate and the coarse time
+        '''
+        s = time.time()
+        foreground = self.coarse_foreground(image, factor, coarse_model)
+        coarse_seconds = time.time() - s
+
+        def tile_filter(y, x):
+            y0, x0 = y // factor, x // factor
+            y1, x1 = -(-(y + self.tile_size) // factor), -(-(x + self.tile_size) // factor)
+            window = foreground[y0:y1, x0:x1]
+            return window.size > 0 and window.max() > threshold
+
+        canvas = self.predict(image, output_path, tile_filter)
+        self.stats["coarse_seconds"] = coarse_seconds
+        self.stats["seconds"] += coarse_seconds
+        return canvas
+
+    def accumulate(self, canvas, weights, logits, origins):
+        H, W = weights.shape
+        for tile_logits, (y, x) in zip(logits, origins):
+            h, w = min(self.tile_size, H - y), min(self.tile_size, W - x)
+            window = self.window[:h, :w]
+            canvas[:, :, y:y + h, x:x + w] += tile_logits[:, :, :h, :w] * window
+            weights[y:y + h, x:x + w] += window
+
+    def normalise(self, canvas, weights, rows=None):
+        # row blocks keep the temporary arrays at the size of a tile row
+        rows = rows or self.tile_size
+        for y in range(0, weights.shape[0], rows):
+            canvas[:, :, y:y + rows] /= weights[None, None, y:y + rows]
+
+
+def mask_agreement(dense, cascade, rows=2048):
+    '''
+    Dice and pixel agreement of the nuclei masks (argmax of head 0) of two canvases, row block by row block
+    '''
+    intersection = total = agree = 0
+    H = dense.shape[2]
+    for y in range(0, H, rows):
+        a = np.asarray(dense[0, :, y:y + rows]).argmax(0) > 0
+        b = np.asarray(cascade[0, :, y:y + rows]).argmax(0) > 0
+        intersection += np.logical_and(a, b).sum()
+        total += a.sum() + b.sum()
+        agree += (a == b).sum()
+    dice = 1. if total == 0 else 2. * intersection / total
+    return {"dice": dice, "pixel_agreement": agree / (H * dense.shape[3])}
+
+
+def instance_foreground(canvas, y0, y1, x0, x1):
+    '''
+    binary map of a canvas window that gets split into instances, nuclei minus normal and cluster edges as in
+    sem2ins (sharpen=0). canvas is either the (3, num_classes, H, W) logits or an (H, W) foreground mask
+    '''
+    if canvas.ndim == 2:
+        return np.asarray(canvas[y0:y1, x0:x1]) > 0
+    seg, nem, cem = np.asarray(canvas[:, :, y0:y1, x0:x1]).argmax(1).astype(np.int8)
+    return seg - nem - cem > 0
+
+
+def label_tile(canvas, y0, y1, x0, x1):
+    '''
+    8-connected instance labels of one tile window, 0 is background
+    '''
+    foreground = instance_foreground(canvas, y0, y1, x0, x1).astype(np.uint8)
+    n, labels = cv2.connectedComponents(foreground, connectivity=8, ltype=cv2.CV_32S)
+    return n - 1, labels
+
+
+def find_roots(parent):
+    # pointer jumping until every id points at its root
+    while True:
+        grand = parent[parent]
+        if np.array_equal(grand, parent):
+            return parent
+        parent = grand
+
+
+def union(parent, a, b):
+    ra, rb = a, b
+    while parent[ra] != ra:
+        ra = parent[ra]
+    while parent[rb] != rb:
+        rb = parent[rb]
+    if ra != rb:
+        parent[max(ra, rb)] = min(ra, rb)
+
+
+def stitch_instances(canvas, tile_size=2048, num_workers=None, output_path=None):
+    '''
+    canvas: (3, num_classes, H, W) logits from TiledPredictor.predict or an (H, W) foreground mask (may be memory-mapped)
+    tile_size: side of the labelling tiles, memory use is a few tiles per worker
+    num_workers: labelling threads, default os.cpu_count()
+    output_path: optional .npy path for a memory-mapped label image
+    returns the (H, W) int32 instance labels, consecutive ids starting at 1
+    '''
+    H, W = canvas.shape[-2:]
+    ys = list(range(0, H, tile_size))
+    xs = list(range(0, W, tile_size))
+    # every tile is labelled one row / column beyond its core, the extra pixels are the first row / column
+    # of the neighbouring tile and tie the two labelings together
+    windows = [(y, min(y + tile_size + 1, H), x, min(x + tile_size + 1, W)) for y in ys for x in xs]
+
+    def first_pass(window):
+        n, labels = label_tile(canvas, *window)
+        return n, labels[0].copy(), labels[:, 0].copy(), labels[-1].copy(), labels[:, -1].copy()
+
+    with ThreadPoolExecutor(num_workers) as pool:
+        strips = list(pool.map(first_pass, windows))
+
+    counts = np.array([strip[0] for strip in strips], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    parent = np.arange(counts.sum() + 1, dtype=np.int64)
+
+    for i in range(len(ys)):
+        for j in range(len(xs)):
+            t = i * len(xs) + j
+            neighbours = []
+            if i + 1 < len(ys):
+                neighbours.append((strips[t][3], strips[t + len(xs)][1], t + len(xs)))  # last row vs first row below
+            if j + 1 < len(xs):
+                neighbours.append((strips[t][4], strips[t + 1][2], t + 1))  # last column vs first column right
+            for mine, theirs, u in neighbours:
+                touching = (mine > 0) & (theirs > 0)
+                if not touching.any():
+                    continue
+                pairs = np.unique(np.stack((mine[touching] + offsets[t], theirs[touching] + offsets[u]), 1), axis=0)
+                for a, b in pairs:
+                    union(parent, a, b)
+
+    roots = find_roots(parent)
+    _, lut = np.unique(roots, return_inverse=True)  # root 0 is background and maps to 0
+    lut = lut.astype(np.int32)
+
+    out = allocate((H, W), output_path, dtype=np.int32)
+
+    def second_pass(args):
+        (y0, y1, x0, x1), offset = args
+        _, labels = label_tile(canvas, y0, y1, x0, x1)
+        ids = np.where(labels > 0, lut[labels + offset], 0)
+        h, w = min(tile_size, H - y0), min(tile_size, W - x0)
+        out[y0:y0 + h, x0:x0 + w] = ids[:h, :w]
+
+    with ThreadPoolExecutor(num_workers) as pool:
+        list(pool.map(second_pass, zip(windows, offsets)))
+
+    if output_path is not None:
+        out.flush()
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path", required=True, help="the path to the trained model")
+    parser.add_argument("--image", required=True, help="the path to the image to segment")
+    parser.add_argument("--output", required=True, help="the .npy file the (3, num_classes, H, W) logits are written to")
+    parser.add_argument("--in_chans", type=int, default=3, help="3 for Histology (rgb), 1 for Radiology (grayscale)")
+    parser.add_argument("--tile_size", type=int, default=512, help="tile size the model was trained on")
+    parser.add_argument("--halo", type=int, default=64, help="overlap blended on each side of a tile")
+    parser.add_argument("--batch_size", type=int, default=4, help="number of tiles per forward pass")
+    parser.add_argument("--instances", default=None, help="optional .npy file the stitched instance labels are written to")
+    parser.add_argument("--stitch_tile_size", type=int, default=2048, help="tile size used for instance labelling")
+    parser.add_argument("--num_workers", type=int, default=None, help="instance labelling threads, default all cores")
+    parser.add_argument("--cascade_factor", type=int, default=0, help="downsampling of the coarse pass, 0 runs every tile")
+    parser.add_argument("--cascade_threshold", type=float, default=0.5, help="coarse nuclei probability that selects a tile")
+    parser.add_argument("--compare_dense", action="store_true", help="also run every tile and report the agreement of the cascade")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s.%(msecs)03d] %(message)s', datefmt='%H:%M:%S',
+                        handlers=[logging.StreamHandler(sys.stdout)])
+
+    model = TransNuSeg(img_size=args.tile_size, in_chans=args.in_chans)
+    load_checkpoint(model, args.model_path, map_location=device)
+    model.to(device)
+    model.eval()
+    model, report = model.fuse_for_inference()
+    logging.info("fused for inference, max abs difference {}".format(report["max_abs_diff"]))
+
+    image = load_image(args.image, args.in_chans)
+    predictor = TiledPredictor(model, tile_size=args.tile_size, halo=args.halo, batch_size=args.batch_size)
+    if args.cascade_factor > 0:
+        canvas = predictor.predict_cascade(image, args.output, args.cascade_factor, args.cascade_threshold)
+        logging.info("cascade: coarse pass {:.1f}s, {} of {} tiles skipped ({:.1f}%)".format(
+            predictor.stats["coarse_seconds"], predictor.stats["skipped"],
+            predictor.stats["tiles"] + predictor.stats["skipped"], 100 * predictor.stats["skip_rate"]))
+    else:
+        canvas = predictor.predict(image, args.output)
+    logging.info("{} tiles in {:.1f}s, {:.2f} tiles/s, logits written to {}".format(
+        predictor.stats["tiles"], predictor.stats["seconds"], predictor.stats["tiles_per_second"], args.output))
+
+    if args.cascade_factor > 0 and args.compare_dense:
+        cascade_stats = predictor.stats
+        # the dense reference goes to a temporary memory-mapped canvas next to the output, compared in row blocks
+        with tempfile.NamedTemporaryFile(suffix=".npy", dir=os.path.dirname(os.path.abspath(args.output))) as dense_file:
+            dense = predictor.predict(image, dense_file.name)
+            agreement = mask_agreement(dense, canvas)
+            del dense
+        logging.info("dense pass {:.1f}s, cascade {:.1f}s; nuclei mask Dice {:.4f}, pixel agreement {:.2f}%".format(
+            predictor.stats["seconds"], cascade_stats["seconds"], agreement["dice"], 100 * agreement["pixel_agreement"]))
+
+    if args.instances is not None:
+        s = time.time()
+        canvas = np.load(args.output, mmap_mode="r")
+        instances = stitch_instances(canvas, args.stitch_tile_size, args.num_workers, args.instances)
+        logging.info("{} instances in {:.1f}s, labels written to {}".format(instances.max(), time.time() - s, args.instances))
+
+
+if __name__ == '__main__':
+    main()
@@ -26,9 +26,10 @@ import sys
 from datetime import datetime
 import argparse
 
-from dataset import MyDataset
+from dataset import DevicePrefetcher, MyDataset
 from utils import *
 from models.transnuseg import TransNuSeg
+from model_io import COMPACT_SUFFIX, load_checkpoint, save_compact
 
 
 device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
@@ -51,6 +52,19 @@ def main():
     num_epoch: number of epoches
     lr: learning rate
     model_path: if used pretrained model, put the path to the pretrained model here
+    save_format: pt (torch.save) or compact (shared weights stored once, memory mapped on load), default=pt
+    save_dtype: storage dtype of the compact format: float32, float16 or bfloat16, default=float32
+    checkpoint_policy: activation checkpointing, none, all, auto (fit memory_budget_mb) or comma separated stages
+        such as encoder,bottleneck,decoder.3 (see TransNuSeg.checkpoint_stages), default=none
+    memory_budget_mb: peak training memory the auto checkpoint policy aims for
+    skip_dropped_paths: stochastic depth skips the residual branches of the dropped samples instead of zeroing them
+    log_interval: log the running losses every log_interval steps (one host sync each), 0 for once per epoch,
+        default=0
+    debug_syncs: count the host-device synchronizations of every step and log their mean per epoch
+    num_workers: DataLoader worker processes decoding the images, default=4
+    prefetch_factor: batches loaded in advance by every worker, default=2
+    edge_backend: contour edges of the predicted nuclei for the distillation loss, torch (on the device) or cv2
+        (utils.edge_detection on the host), default=torch
     '''
 
     parser = argparse.ArgumentParser()
@@ -65,6 +79,16 @@ def main():
     parser.add_argument("--num_epoch",required=True,help='number of epoches')
     parser.add_argument("--lr",required=True,help="learning rate")
     parser.add_argument("--model_path",default=None,help="the path to the pretrained model")
+    parser.add_argument("--save_format",default="pt",choices=["pt","compact"],help="format of the saved model")
+    parser.add_argument("--save_dtype",default="float32",choices=["float32","float16","bfloat16"],help="storage dtype of the compact format")
+    parser.add_argument("--checkpoint_policy",default="none",help="activation checkpointing: none, all, auto or comma separated stages")
+    parser.add_argument("--memory_budget_mb",type=float,default=None,help="peak training memory budget of the auto checkpoint policy")
+    parser.add_argument("--skip_dropped_paths",action="store_true",help="skip the compute of the samples dropped by stochastic depth")
+    parser.add_argument("--log_interval",type=int,default=0,help="log the running losses every n steps, 0 for once per epoch")
+    parser.add_argument("--debug_syncs",action="store_true",help="count the host-device synchronizations per step")
+    parser.add_argument("--num_workers",type=int,default=4,help="DataLoader worker processes")
+    parser.add_argument("--prefetch_factor",type=int,default=2,help="batches loaded in advance by every worker")
+    parser.add_argument("--edge_backend",default="torch",choices=["torch","cv2"],help="contour edge extraction of the distillation loss")
 
     args = parser.parse_args()
     
@@ -96,10 +120,10 @@ def main():
     
     
     
-    model = TransNuSeg(img_size=IMG_SIZE,in_chans=channel)
+    model = TransNuSeg(img_size=IMG_SIZE,in_chans=channel,skip_dropped_paths=args.skip_dropped_paths)
     if args.model_path is not None:
         try:
-            model.load_state_dict(torch.load(args.model_path))
+            load_checkpoint(model, args.model_path)
         except Exception as err:
             print("{} In Loading previous model weights".format(err))
             
@@ -113,6 +137,10 @@ def main():
                             format='[%(asctime)s.%(msecs)03d] %(message)s', datefmt='%H:%M:%S')
     logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
     logging.info("Batch size : {} , epoch num: {}, alph: {}, beta : {}, gamma: {}, sharing_ratio = {}".format(batch_size,num_epoch,alpha,beta,gamma,sharing_ratio))
+    checkpointed = model.set_checkpoint_policy(args.checkpoint_policy, args.memory_budget_mb,
+                                               example_input=torch.rand(1, channel, IMG_SIZE, IMG_SIZE, device=device),
+                                               batch_size=batch_size)
+    logging.info("Activation checkpointing: {}".format(", ".join(checkpointed) or "none"))
 
     
     if dataset == "Radiology":
@@ -140,8 +168,13 @@ def main():
         logging.info("Wrong Dataset type")
         return 0
 
-    trainloader = torch.utils.data.DataLoader(train_set, batch_size=batch_size, shuffle=True)
-    testloader = torch.utils.data.DataLoader(test_set, batch_size=batch_size, shuffle=False)
+    # the dataset returns uint8 CPU tensors: workers decode in the background into pinned memory and
+    # DevicePrefetcher overlaps the copy of the next batch with the current step
+    loader_args = {"num_workers": args.num_workers, "pin_memory": torch.device(device).type == "cuda"}
+    if args.num_workers > 0:
+        loader_args.update(persistent_workers=True, prefetch_factor=args.prefetch_factor)
+    trainloader = torch.utils.data.DataLoader(train_set, batch_size=batch_size, shuffle=True, **loader_args)
+    testloader = torch.utils.data.DataLoader(test_set, batch_size=batch_size, shuffle=False, **loader_args)
  
     dataloaders = {"train":trainloader,"test":testloader}
     dataset_sizes = {"train":len(trainloader),"test":len(testloader)}
@@ -153,12 +186,8 @@ def main():
         
     
     
-    ce_loss1 = CrossEntropyLoss()
-    dice_loss1 = DiceLoss(num_classes)
-    ce_loss2 = CrossEntropyLoss()
-    dice_loss2 = DiceLoss(num_classes)
-    ce_loss3 = CrossEntropyLoss()
-    dice_loss3 = DiceLoss(num_classes)
+    # 0.4 CE + 0.6 Dice of the nuclei, normal edge and cluster edge heads, weighted by alpha, beta, gamma
+    seg_loss = MultiHeadDiceCELoss(num_classes, (alpha, beta, gamma)).to(device)
     dice_loss_dis = DiceLoss(num_classes)
 
 
@@ -176,92 +205,78 @@ def main():
         if epoch > best_epoch + 50:
             break
         for phase in ['train','test']:
-            running_loss = 0
-            running_loss_wo_dis = 0
-            running_loss_seg = 0
+            # losses are summed on the device and only read back per log_interval / epoch
+            running = RunningMeans(("loss", "loss_wo_dis", "loss_seg"), device)
+            syncs = 0
             s = time.time()  # start time for this epoch
             if phase == 'train':
                 model.train()  # Set model to training mode
             else:
                 model.eval()   
 
-            for i, d in enumerate(dataloaders[phase]):
+            for i, d in enumerate(DevicePrefetcher(dataloaders[phase], device)):
+                sync_counter = SyncCounter(args.debug_syncs)
+                with sync_counter, torch.set_grad_enabled(phase == 'train'):
               
-                img, instance_seg_mask, semantic_seg_mask,normal_edge_mask,cluster_edge_mask = d
-             
-                img = img.float()    
-                img = img.to(device)
-                instance_seg_mask = instance_seg_mask.to(device)
-                semantic_seg_mask = semantic_seg_mask.to(device)
-                
-                semantic_seg_mask2 = semantic_seg_mask.cpu().detach().numpy()
-                normal_edge_mask2 = normal_edge_mask.cpu().detach().numpy()
-                cluster_edge_mask2 = cluster_edge_mask.cpu().detach().numpy()
-                
-                cluster_edge_mask = cluster_edge_mask.to(device)
-                # print('img shape ',img.shape)
-                # print('semantic_seg_mask shape ',semantic_seg_mask.shape)
+                    # already on the device, image in [0, 1]
+                    img, instance_seg_mask, semantic_seg_mask,normal_edge_mask,cluster_edge_mask = d
+                    # print('img shape ',img.shape)
+                    # print('semantic_seg_mask shape ',semantic_seg_mask.shape)
                 
 
-                output1,output2,output3 = model(img)
+                    output1,output2,output3 = model(img)
                 
-                loss_seg = 0.4*ce_loss1(output1, semantic_seg_mask.long( )) + 0.6*dice_loss1(output1, semantic_seg_mask.float(), softmax=True)
-                loss_nor = 0.4*ce_loss2(output2, normal_edge_mask.long()) + 0.6*dice_loss2(output2, normal_edge_mask.float(), softmax=True)
-                loss_clu = 0.4*ce_loss3(output3, cluster_edge_mask.long()) + 0.6*dice_loss3(output3, cluster_edge_mask.float(), softmax=True)
-                # print("loss_seg {}, loss_nor {}, loss_clu {}".format(loss_seg,loss_nor,loss_clu))
-                if epoch < 10:
-                    ratio_d = 1
-                elif epoch < 20:
-                    ratio_d = 0.7
-                elif epoch < 30:
-                    ratio_d = 0.4
-                # elif epoch < 40:
-                #     ratio_d = 0.1
-                # # elif epoch >= 40:
-                # #     ratio_d = 0
-                # else:
-                #     ratio_d = 0
+                    loss_heads, (loss_seg, loss_nor, loss_clu) = seg_loss(torch.stack([output1, output2, output3]),
+                                                                          torch.stack([semantic_seg_mask, normal_edge_mask, cluster_edge_mask]))
+                    # print("loss_seg {}, loss_nor {}, loss_clu {}".format(loss_seg,loss_nor,loss_clu))
+                    if epoch < 10:
+                        ratio_d = 1
+                    elif epoch < 20:
+                        ratio_d = 0.7
+                    elif epoch < 30:
+                        ratio_d = 0.4
+                    # elif epoch < 40:
+                    #     ratio_d = 0.1
+                    # # elif epoch >= 40:
+                    # #     ratio_d = 0
+                    # else:
+                    #     ratio_d = 0
                 
-                ### calculating the distillation loss
-                m = torch.softmax(output1, dim=1)
-                m = torch.argmax(m, dim=1)
-                # m = m.squeeze(0)
-                m = m.cpu().detach().numpy()
+                    ### calculating the distillation loss
+                    m = torch.argmax(output1.detach(), dim=1)
+                    if args.edge_backend == "torch":
+                        pred_edge_1 = edge_detection_torch(m)
+                    else:
+                        pred_edge_1 = edge_detection(m.cpu().numpy(),channel)
+                        pred_edge_1 = torch.tensor(pred_edge_1).to(device)
+                    pred_edge_2 = (output2-output3).clamp(min=0)
                 
-        
-                b = torch.argmax(torch.softmax(output2, dim=1), dim=1)
                 
+                    # print("pred_edge_1 shape ",pred_edge_1.shape)
+                    # print("pred_edge_2 shape ",pred_edge_2.shape)
+                    dis_loss = dice_loss_dis(pred_edge_2,pred_edge_1.float())
                 
-                b2 = b.cpu().detach().numpy()
-                # print('b2 shape',b2.shape)
+                    ### calculating total loss
+                    loss = loss_heads + ratio_d*dis_loss
+
+                    ## loss, loss without distillation loss, loss for nuclei segmantation
+                    running.add(loss, loss_heads, loss_seg)
+                    if phase == 'train':
+                        optimizer.zero_grad()
+                        loss.backward()
+                        optimizer.step()
+                syncs += sync_counter.count
+
+                if args.log_interval and (i + 1) % args.log_interval == 0:
+                    logging.info('Epoch {}, step {}: {} {}'.format(epoch+1, i+1, running.means(), phase))
 
-                
-                c = torch.argmax(torch.softmax(output3, dim=1), dim=1)
-                pred_edge_1 = edge_detection(m.copy(),channel)
-                pred_edge_1 = torch.tensor(pred_edge_1).to(device)
-                pred_edge_2 = output2-output3
-                pred_edge_2[pred_edge_2<0] = 0
-                
-                
-                # print("pred_edge_1 shape ",pred_edge_1.shape)
-                # print("pred_edge_2 shape ",pred_edge_2.shape)
-                dis_loss = dice_loss_dis(pred_edge_2,pred_edge_1.float())
-                
-                ### calculating total loss
-                loss = alpha*loss_seg + beta*loss_nor + gamma*loss_clu + ratio_d*dis_loss
-
-                running_loss+=loss.item()
-                running_loss_wo_dis += (alpha*loss_seg + beta*loss_nor + gamma*loss_clu).item() ## Loss without distillation loss
-                running_loss_seg += loss_seg.item() ## Loss for nuclei segmantation
-                if phase == 'train':
-                    optimizer.zero_grad()
-                    loss.backward()
-                    optimizer.step()
-                
             e = time.time()
-            epoch_loss = running_loss / dataset_sizes[phase]
-            epoch_loss_wo_dis = running_loss_wo_dis / dataset_sizes[phase] ## Epoch Loss without distillation loss
-            epoch_loss_seg = running_loss_seg / dataset_sizes[phase]       ## Epoch Loss for nuclei segmantation
+            means = running.means()
+            epoch_loss = means["loss"]
+            epoch_loss_wo_dis = means["loss_wo_dis"] ## Epoch Loss without distillation loss
+            epoch_loss_seg = means["loss_seg"]       ## Epoch Loss for nuclei segmantation
+            if args.debug_syncs:
+                logging.info('Epoch {},: {:.2f} host-device syncs per step, {}'.format(epoch+1, syncs / max(running.steps, 1), phase))
             logging.info('Epoch {},: loss {}, {},time {}'.format(epoch+1,  epoch_loss,phase,e-s))
             logging.info('Epoch {},: loss without distillation {}, {},time {}'.format(epoch+1,  epoch_loss_wo_dis,phase,e-s))
             logging.info('Epoch {},: loss seg {}, {},time {}'.format(epoch+1,  epoch_loss_seg,phase,e-s))
@@ -280,36 +295,36 @@ def main():
     draw_loss(train_loss,test_loss,str(now))
     
     create_dir('./saved')
-    torch.save(best_model_wts, './saved/model_epoch:{}_testloss:{}_{}.pt'.format(best_epoch,best_loss,str(now)))
-    logging.info('Model saved. at {}'.format('./saved/model_spoch:{}_testloss:{}_{}.pt'.format(best_epoch,best_loss,str(now))))
+    if args.save_format == "compact":
+        save_path = './saved/model_epoch:{}_testloss:{}_{}{}'.format(best_epoch,best_loss,str(now),COMPACT_SUFFIX)
+        save_compact(best_model_wts, save_path, dtype=getattr(torch, args.save_dtype))
+    else:
+        save_path = './saved/model_epoch:{}_testloss:{}_{}.pt'.format(best_epoch,best_loss,str(now))
+        torch.save(best_model_wts, save_path)
+    logging.info('Model saved. at {}'.format(save_path))
 
 
     
     model.load_state_dict(best_model_wts)
     model.eval()
 
-    dice_acc_test = 0
+    dice_acc_test = torch.zeros((), device=device)
     dice_loss_test = DiceLoss(num_classes)
     
     with torch.no_grad():
-        for i, d in enumerate(testloader, 0):
+        for i, d in enumerate(DevicePrefetcher(testloader, device), 0):
             img, instance_seg_mask, semantic_seg_mask,normal_edge_mask,cluster_edge_mask = d
-            semantic_seg_mask2 = semantic_seg_mask.cpu().detach().numpy()
-            normal_edge_mask2 = normal_edge_mask.cpu().detach().numpy()
-            cluster_edge_mask2 = cluster_edge_mask.cpu().detach().numpy()
             # img = img.unsqueeze(0)
-            img = img.float()    
-            img = img.to(device)
 
             # semantic_seg_mask = semantic_seg_mask.unsqueeze(0).float()
             
             
             output1,output2,output3 = model(img)
             d_l = dice_loss_test(output1, semantic_seg_mask.float(), softmax=True)
-            dice_acc_test += 1- d_l.item()
+            dice_acc_test += 1- d_l
                 
   
-    logging.info("dice_acc {}".format(dice_acc_test/dataset_sizes['test']))
+    logging.info("dice_acc {}".format(dice_acc_test.item()/dataset_sizes['test']))
 
 
   
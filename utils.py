@@ -8,6 +8,7 @@ from torch.nn.modules.utils import _pair
 from scipy import ndimage
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.utils.checkpoint as checkpoint
 from einops import rearrange
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
@@ -26,6 +27,7 @@ import matplotlib.pyplot as plt
 import time
 import logging
 import sys
+import warnings
 from datetime import datetime
 
 
@@ -39,12 +41,8 @@ class DiceLoss(nn.Module):
         self.n_classes = n_classes
 
     def _one_hot_encoder(self, input_tensor):
-        tensor_list = []
-        for i in range(self.n_classes):
-            temp_prob = input_tensor == i  # * torch.ones_like(input_tensor)
-            tensor_list.append(temp_prob.unsqueeze(1))
-        output_tensor = torch.cat(tensor_list, dim=1)
-        return output_tensor.float()
+        classes = torch.arange(self.n_classes, device=input_tensor.device).view(1, -1, *[1] * (input_tensor.dim() - 1))
+        return (input_tensor.unsqueeze(1) == classes).float()
 
     def _dice_loss(self, score, target):
         target = target.float()
@@ -63,17 +61,113 @@ class DiceLoss(nn.Module):
         if weight is None:
             weight = [1] * self.n_classes
         assert inputs.size() == target.size(), 'predict {} & target {} shape do not match'.format(inputs.size(), target.size())
-        class_wise_dice = []
         loss = 0.0
         for i in range(0, self.n_classes):
             dice = self._dice_loss(inputs[:, i], target[:, i])
-            class_wise_dice.append(1.0 - dice.item())
             loss += dice * weight[i]
         return loss / self.n_classes
     
     
     
 
+class MultiHeadDiceCELoss(nn.Module):
+    '''
+    CE + Dice of several segmentation heads in one batched pass: a single log-softmax, one one-hot encoding and
+    reductions over the stacked heads, the same value as running for every head h
+        head_weights[h] * (ce_weight * CrossEntropyLoss(weight=class_weights)(logits[h], target[h])
+                           + dice_weight * DiceLoss(n_classes)(logits[h], target[h], class_weights, softmax=True))
+    n_classes: number of classes of every head
+    head_weights: weight of every head, e.g. (alpha, beta, gamma) for the nuclei, normal edge and cluster edge heads
+    class_weights: weight of every class in CE and Dice, default all 1
+    '''
+    def __init__(self, n_classes, head_weights, class_weights=None, ce_weight=0.4, dice_weight=0.6, smooth=1e-5):
+        super(MultiHeadDiceCELoss, self).__init__()
+        self.n_classes = n_classes
+        self.ce_weight = ce_weight
+        self.dice_weight = dice_weight
+        self.smooth = smooth
+        if class_weights is None:
+            class_weights = [1.] * n_classes
+        self.register_buffer("head_weights", torch.tensor(head_weights, dtype=torch.float), persistent=False)
+        self.register_buffer("class_weights", torch.tensor(class_weights, dtype=torch.float), persistent=False)
+
+    def forward(self, logits, target):
+        '''
+        logits: heads, B, n_classes, H, W, e.g. torch.stack([output1, output2, output3])
+        target: heads, B, H, W class ids
+        returns the weighted total and the unweighted loss of every head (heads,)
+        '''
+        target = target.long()
+        log_p = torch.log_softmax(logits.float(), dim=2)
+        p = log_p.exp()
+
+        # CE, weighted mean of the negative log likelihood of the target classes
+        pixel_weights = self.class_weights[target]
+        nll = -log_p.gather(2, target.unsqueeze(2)).squeeze(2)
+        ce = (nll * pixel_weights).sum((1, 2, 3)) / pixel_weights.sum((1, 2, 3))
+
+        # Dice per head and class
+        classes = torch.arange(self.n_classes, device=target.device).view(1, 1, -1, 1, 1)
+        one_hot = (target.unsqueeze(2) == classes).to(p.dtype)
+        intersect = (p * one_hot).sum((1, 3, 4))
+        y_sum = one_hot.sum((1, 3, 4))
+        z_sum = (p * p).sum((1, 3, 4))
+        dice = 1 - (2 * intersect + self.smooth) / (z_sum + y_sum + self.smooth)
+        dice = (dice * self.class_weights).sum(1) / self.n_classes
+
+        losses = self.ce_weight * ce + self.dice_weight * dice
+        return (losses * self.head_weights).sum(), losses
+
+
+class RunningMeans:
+    '''
+    running sums of scalar losses kept on the device: add() queues an addition without synchronizing with the
+    host, means() copies the sums to the host once, e.g. per logging interval or epoch
+    '''
+    def __init__(self, names, device):
+        self.names = tuple(names)
+        self.sums = torch.zeros(len(self.names), device=device)
+        self.steps = 0
+
+    def add(self, *values):
+        self.sums += torch.stack([v.detach().float() for v in values])
+        self.steps += 1
+
+    def means(self):
+        return dict(zip(self.names, (self.sums / max(self.steps, 1)).tolist()))
+
+
+class SyncCounter:
+    '''
+    counts the host-device synchronizations inside a with block (CUDA sync debug mode warnings), to see how many
+    a training step does. Always 0 without CUDA.
+
+        with SyncCounter() as syncs:
+            step()
+        print(syncs.count)
+    '''
+    def __init__(self, enabled=True):
+        self.enabled = enabled and torch.cuda.is_available()
+        self.count = 0
+
+    def __enter__(self):
+        self.count = 0
+        if self.enabled:
+            self.catcher = warnings.catch_warnings(record=True)
+            self.records = self.catcher.__enter__()
+            warnings.simplefilter("always")
+            self.mode = torch.cuda.get_sync_debug_mode()
+            torch.cuda.set_sync_debug_mode("warn")
+        return self
+
+    def __exit__(self, *exc):
+        if self.enabled:
+            torch.cuda.set_sync_debug_mode(self.mode)
+            self.catcher.__exit__(*exc)
+            self.count = sum("synchronizing" in str(w.message) for w in self.records)
+        return False
+
+
 def calculate_F1_score(prediction, label):
     intersection = np.logical_and(prediction, label)
     dice = 2 * np.sum(intersection) / (np.sum(prediction) + np.sum(label))
@@ -199,6 +293,18 @@ def sem2ins(seg_mask,nem,cem,sharpen=0):
         # seg_mask_g = cv2.cvtColor(seg_mask,cv2.COLOR_BGR2GRAY) 
     return seg_mask_g
 
+def sem2ins_labels(seg_mask,nem,cem):
+    """
+    sem2ins (sharpen=0) without the round trip through 1.png, the filled contours are numbered from 1 so that
+    0 stays background
+    """
+    result = (seg_mask.astype(np.int16) - nem - cem > 0).astype(np.uint8)
+    contours, _ = cv2.findContours(result, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    instances = np.zeros(result.shape, np.int32)
+    for i, cnt in enumerate(contours):
+        cv2.drawContours(instances, [cnt], 0, i + 1, -1)
+    return instances
+
 def sem2ins_smooth(seg_mask,nem,cem):
     edge = nem + cem
     edge = np.float32(edge)
@@ -751,7 +857,7 @@ def edge_detection(m,channel = 1):
     # print("m shape ",m.shape)
     for i in range(b):
         contours, _ = cv2.findContours(m[i], cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        blank = np.zeros((512,512))
+        blank = np.zeros((h,w))
         # draw the contours on a copy of the original image
         cv2.drawContours(blank, contours, -1, 1, 2)
         outputs[i] = blank
@@ -759,4 +865,20 @@ def edge_detection(m,channel = 1):
 
 
     return outputs
-    
+
+
+def edge_detection_torch(m):
+    '''
+    device side counterpart of edge_detection: 2 pixel wide contour edges of the foreground (m > 0) of a batch of
+    label maps, as the morphological gradient (3x3 max pool dilation minus min pool erosion, outside of the image
+    counted as background), so the edges are computed batched where m lives without a host round trip.
+    Unlike cv2.findContours with RETR_EXTERNAL, the boundaries of holes inside a nucleus are edges too.
+    m: B, H, W (or H, W) label map
+    returns a float tensor of the same shape with 1 on the edges
+    '''
+    squeeze = m.dim() == 2
+    m = (m > 0).float().view(-1, 1, *m.shape[-2:])
+    dilated = F.max_pool2d(m, 3, stride=1, padding=1)
+    eroded = -F.max_pool2d(-F.pad(m, (1, 1, 1, 1)), 3, stride=1)
+    edges = (dilated - eroded).squeeze(1)
+    return edges[0] if squeeze else edges